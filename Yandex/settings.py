@@ -11,10 +11,71 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DATA_UPLOAD_MAX_MEMORY_SIZE = 5242880*100
+# Предельный размер тела после распаковки Content-Encoding: gzip/deflate
+IMPORTS_MAX_DECOMPRESSED_SIZE = DATA_UPLOAD_MAX_MEMORY_SIZE
+
+# Способ загрузки жителей и родственных связей в базу при импорте:
+# 'insert' - один большой INSERT ... VALUES, 'copy_text' / 'copy_binary' - COPY FROM STDIN
+IMPORTS_LOADER = 'insert'
+
+# Число потоков в каждом воркере, которые выполняют асинхронные импорты (Prefer: respond-async)
+IMPORTS_ASYNC_WORKERS = 2
+# Через сколько секунд без завершения асинхронный импорт считается потерянным и отдается как failed
+IMPORTS_ASYNC_JOB_TIMEOUT = 30 * 60
+
+# Импорты больше порога (число жителей) валидируются шардами в пуле процессов, None - всегда последовательно.
+# Пересылка шардов между процессами стоит родителю примерно половину последовательной проверки,
+# поэтому выигрыш возможен только на нескольких свободных ядрах - включать после замера на целевой машине.
+# Число процессов None - по количеству ядер
+IMPORTS_PARALLEL_VALIDATION_THRESHOLD = None
+IMPORTS_VALIDATION_SHARD_SIZE = 5000
+IMPORTS_VALIDATION_PROCESSES = None
+
+# Без заголовка Idempotency-Key считать повтором импорт с тем же телом запроса (по sha256)
+IMPORTS_DEDUPLICATE_BY_DIGEST = False
+
+# Как строится ответ GET /imports/<id>/citizens:
+# 'python' - все жители грузятся в память и сериализуются целиком,
+# 'stream' - читаются серверным курсором пачками и отдаются клиенту потоком
+# 'postgres' - то же, но JSON каждого жителя собирает сам Postgres
+IMPORTS_CITIZENS_ENGINE = 'stream'
+
+# Размер страницы GET /imports/<id>/citizens по умолчанию и максимальный ?limit=
+IMPORTS_CITIZENS_PAGE_SIZE = 1000
+IMPORTS_CITIZENS_MAX_PAGE_SIZE = 10000
+
+# Как считается GET /imports/<id>/citizens/birthdays:
+# 'materialized' - чтение агрегата, который поддерживается при импорте и PATCH,
+# 'sql' - группировка связей по (житель, месяц) одним запросом на каждый GET
+IMPORTS_BIRTHDAYS_ENGINE = 'materialized'
+
+# Как считается GET /imports/<id>/towns/stat/percentile/age:
+# 'histogram' - по гистограмме дат рождения в каждом городе, которая поддерживается при импорте и PATCH,
+# 'numpy' - по колонкам (город, дата рождения) всех жителей, векторно на каждый GET,
+# 'python' - по всем жителям импорта на каждый GET
+IMPORTS_PERCENTILE_ENGINE = 'histogram'
+# Сколько результатов перцентилей на (импорт, версия) держит в памяти каждый воркер до смены UTC-даты, 0 - не кешировать
+IMPORTS_PERCENTILE_CACHE_SIZE = 1024
+
+# Общий для воркеров gunicorn файловый кеш готовых ответов GET-запросов по импорту.
+# Лучше держать его в tmpfs (/dev/shm). Размер в байтах для каждой базы, при превышении вытесняются
+# давно не использованные ответы, 0 - кеш выключен. В тестах кеш по умолчанию выключен (см. TEST_RUNNER)
+IMPORTS_RESPONSE_CACHE_DIR = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                                          'yandex-imports-cache')
+IMPORTS_RESPONSE_CACHE_SIZE = 256 * 1024 * 1024
+IMPORTS_RESPONSE_CACHE_MAX_ENTRY_SIZE = 32 * 1024 * 1024
+
+TEST_RUNNER = 'imports.tests.runner.ImportsTestRunner'
+
+# Реестр импортов в памяти каждого воркера: известные import_id и карты citizen_id -> pk.
+# Размер - суммарное число жителей в картах (импорт без карты считается за одного),
+# при превышении вытесняются давно не использованные импорты, 0 - реестр выключен
+IMPORTS_REGISTRY_SIZE = 2 * 1000 * 1000
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.2/howto/deployment/checklist/
@@ -0,0 +1,132 @@
+from collections import Counter
+
+import numpy
+
+birthdays_table = 'imports_birthdaypresents'
+towns_table = 'imports_townbirthdates'
+
+
+def count_birthdays(citizens, relatives):
+    """
+    Агрегат подарков по месяцам для нового импорта - по уже провалидированным данным в памяти.
+    Запрос по только что загруженным таблицам без статистики планировщик может выполнить очень плохо
+    """
+    months = {citizen.citizen_id: citizen.birth_date.month for citizen in citizens}
+    counts = Counter()
+    for citizen_id, citizen_relatives in relatives.items():
+        for rel_id in citizen_relatives:
+            counts[citizen_id, months[rel_id]] += 1
+    return counts
+
+
+# Ненулевые ячейки (citizen_id, месяц, подарки) импорта, посчитанные группировкой по связям
+birthdays_sql = 'select c.citizen_id, extract(month from r.birth_date)::int, count(*) ' \
+                'from imports_citizen c, imports_citizen_relatives cr, imports_citizen r ' \
+                'where c.import_id = %s and cr.from_citizen_id = c.id and r.id = cr.to_citizen_id ' \
+                'group by c.citizen_id, extract(month from r.birth_date)'
+
+
+def build_birthdays(cursor, import_id):
+    """
+    Считает агрегат подарков по месяцам для уже загруженного импорта одним запросом
+    """
+    cursor.execute('insert into ' + birthdays_table + ' (citizen_id, month, presents, import_id) '
+                   'select b.*, %s from (' + birthdays_sql + ') b', [import_id, import_id])
+
+
+def birthday_deltas(citizen_id, old_month, new_month, old_relatives, new_relatives):
+    """
+    Изменения агрегата от PATCH одного жителя. old_relatives/new_relatives - {citizen_id: месяц рождения}
+    родственников до и после изменения (new_relatives = None, если родственники не менялись).
+    Каждая связь a - b дает подарок a в месяце b и b в месяце a; связь с самим собой - один подарок
+    """
+    deltas = Counter()
+    relatives = old_relatives
+    if new_relatives is not None:
+        for rel_id, month in old_relatives.items():
+            if rel_id not in new_relatives:
+                deltas[citizen_id, month] -= 1
+                if rel_id != citizen_id:
+                    deltas[rel_id, old_month] -= 1
+        for rel_id, month in new_relatives.items():
+            if rel_id not in old_relatives:
+                deltas[citizen_id, month] += 1
+                if rel_id != citizen_id:
+                    deltas[rel_id, old_month] += 1
+        relatives = new_relatives
+    if new_month != old_month:
+        for rel_id in relatives:
+            deltas[rel_id, old_month] -= 1
+            deltas[rel_id, new_month] += 1
+    return {key: delta for key, delta in deltas.items() if delta}
+
+
+def edges_birthday_deltas(old_edges, new_edges, old_months, new_months):
+    """
+    Изменения агрегата от пакета PATCH. Связи - пары citizen_id (a <= b): old_edges - все связи
+    затронутых жителей до изменений, new_edges - они же после. Месяцы - {citizen_id: месяц} до и после
+    """
+    deltas = Counter()
+    for edges, months, sign in ((old_edges, old_months, -1), (new_edges, new_months, 1)):
+        for a, b in edges:
+            deltas[a, months[b]] += sign
+            if a != b:
+                deltas[b, months[a]] += sign
+    return {key: delta for key, delta in deltas.items() if delta}
+
+
+def birthday_upsert(import_id, deltas):
+    """
+    Запрос (и параметры), прибавляющий deltas к агрегату подарков. Годится и как отдельный запрос, и как CTE
+    """
+    citizen_ids, months = zip(*deltas.keys())
+    return ('insert into ' + birthdays_table + ' (import_id, citizen_id, month, presents) '
+            'select %s, unnest(%s::int[]), unnest(%s::int[]), unnest(%s::int[]) '
+            'on conflict (import_id, month, citizen_id) '
+            'do update set presents = ' + birthdays_table + '.presents + excluded.presents',
+            [import_id, list(citizen_ids), list(months), list(deltas.values())])
+
+
+def apply_birthday_deltas(cursor, import_id, deltas):
+    if deltas:
+        cursor.execute(*birthday_upsert(import_id, deltas))
+
+
+def count_town_birth_dates(citizens):
+    return Counter((citizen.town, citizen.birth_date) for citizen in citizens)
+
+
+def build_town_birth_dates(cursor, import_id):
+    cursor.execute('insert into ' + towns_table + ' (import_id, town, birth_date, citizens) '
+                   'select import_id, town, birth_date, count(*) from imports_citizen '
+                   'where import_id = %s group by import_id, town, birth_date', [import_id])
+
+
+def town_upsert(import_id, deltas):
+    towns, birth_dates = zip(*deltas.keys())
+    return ('insert into ' + towns_table + ' (import_id, town, birth_date, citizens) '
+            'select %s, unnest(%s::varchar[]), unnest(%s::date[]), unnest(%s::int[]) '
+            'on conflict (import_id, town, birth_date) '
+            'do update set citizens = ' + towns_table + '.citizens + excluded.citizens',
+            [import_id, list(towns), list(birth_dates), list(deltas.values())])
+
+
+def apply_town_deltas(cursor, import_id, deltas):
+    if deltas:
+        cursor.execute(*town_upsert(import_id, deltas))
+
+
+def percentiles_from_counts(values, counts, q):
+    """
+    numpy.percentile(numpy.repeat(values, counts), q) с линейной интерполяцией,
+    но без разворачивания гистограммы: values отсортированы по возрастанию
+    """
+    cumulative = numpy.cumsum(counts)
+    indices = numpy.true_divide(q, 100) * (cumulative[-1] - 1)
+    indices_below = numpy.floor(indices).astype(numpy.intp)
+    indices_above = numpy.minimum(indices_below + 1, cumulative[-1] - 1)
+    weights_above = indices - indices_below
+    values = numpy.asarray(values)
+    below = values[numpy.searchsorted(cumulative, indices_below, side='right')]
+    above = values[numpy.searchsorted(cumulative, indices_above, side='right')]
+    return below * (1 - weights_above) + above * weights_above
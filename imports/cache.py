@@ -0,0 +1,227 @@
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse
+
+logger = logging.getLogger(__name__)
+
+# Счетчики в общем файле статистики: попадания, промахи, вытеснения, инвалидации, текущий размер кеша
+STATS_FIELDS = ('hits', 'misses', 'evictions', 'invalidations', 'size')
+STATS_FORMAT = '<5q'
+STATS_SIZE = struct.calcsize(STATS_FORMAT)
+STATS_FILE = 'stats'
+
+
+def cache_enabled():
+    return bool(settings.IMPORTS_RESPONSE_CACHE_SIZE)
+
+
+def database_dir():
+    # У каждой базы свой каталог со своими размером, статистикой и вытеснением:
+    # импорты с одинаковыми id из разных баз не пересекаются и не вытесняют друг друга
+    return os.path.join(settings.IMPORTS_RESPONSE_CACHE_DIR, connection.settings_dict['NAME'])
+
+
+def import_dir(import_id):
+    # Ответы одного импорта лежат в своем каталоге, чтобы инвалидировать их одним rmtree
+    return os.path.join(database_dir(), str(import_id))
+
+
+@contextmanager
+def locked_stats():
+    """
+    Дает изменять счетчики под эксклюзивной блокировкой файла статистики - она же
+    сериализует между воркерами учет размера кеша и вытеснение
+    """
+    root = database_dir()
+    os.makedirs(root, exist_ok=True)
+    fd = os.open(os.path.join(root, STATS_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        data = os.pread(fd, STATS_SIZE, 0)
+        stats = dict(zip(STATS_FIELDS, struct.unpack(STATS_FORMAT, data) if len(data) == STATS_SIZE
+                         else (0,) * len(STATS_FIELDS)))
+        yield stats
+        os.pwrite(fd, struct.pack(STATS_FORMAT, *(stats[field] for field in STATS_FIELDS)), 0)
+    finally:
+        os.close(fd)
+
+
+def get_stats():
+    with locked_stats() as stats:
+        result = dict(stats)
+    requests = result['hits'] + result['misses']
+    result['hit_rate'] = result['hits'] / requests if requests else 0.0
+    return result
+
+
+def fetch(import_id, key):
+    path = os.path.join(import_dir(import_id), key)
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        # mtime служит отметкой последнего обращения для LRU
+        os.utime(path)
+    except FileNotFoundError:
+        content = None
+    with locked_stats() as stats:
+        stats['hits' if content is not None else 'misses'] += 1
+    return content
+
+
+def put(import_id, key, content):
+    directory = import_dir(import_id)
+    os.makedirs(directory, exist_ok=True)
+    # Пишем во временный файл и атомарно переименовываем, чтобы другие воркеры не прочли запись наполовину
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, os.path.join(directory, key))
+    with locked_stats() as stats:
+        stats['size'] += len(content)
+        if stats['size'] > settings.IMPORTS_RESPONSE_CACHE_SIZE:
+            evict(stats)
+
+
+def evict(stats):
+    """
+    Удаляет самые давно использованные ответы базы, пока ее кеш не уложится в IMPORTS_RESPONSE_CACHE_SIZE.
+    Размер заодно пересчитывается по факту, исправляя расхождения от гонок воркеров
+    """
+    entries = []
+    for directory, _, files in os.walk(database_dir()):
+        for name in files:
+            if name == STATS_FILE or name.startswith('.tmp'):
+                continue
+            try:
+                entry_stat = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, os.path.join(directory, name)))
+    entries.sort()
+    size = sum(entry[1] for entry in entries)
+    for _, entry_size, path in entries:
+        if size <= settings.IMPORTS_RESPONSE_CACHE_SIZE:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            continue
+        size -= entry_size
+        stats['evictions'] += 1
+    stats['size'] = size
+
+
+def invalidate(import_id):
+    directory = import_dir(import_id)
+    if not os.path.isdir(directory):
+        return
+    with locked_stats() as stats:
+        for name in os.listdir(directory):
+            try:
+                stats['size'] -= os.path.getsize(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+        shutil.rmtree(directory, ignore_errors=True)
+        stats['invalidations'] += 1
+
+
+def tee(import_id, key, content):
+    # Потоковый ответ отдаем клиенту как есть, а в кеш кладем, только если он дочитан до конца и не слишком велик
+    chunks = []
+    size = 0
+    for chunk in content:
+        if chunks is not None:
+            size += len(chunk)
+            if size > settings.IMPORTS_RESPONSE_CACHE_MAX_ENTRY_SIZE:
+                chunks = None
+            else:
+                chunks.append(chunk)
+        yield chunk
+    if chunks is not None:
+        store(import_id, key, b''.join(chunks))
+
+
+def store(import_id, key, content):
+    try:
+        put(import_id, key, content)
+    except OSError as e:
+        logger.debug("Can't store response in cache. {}".format(e))
+
+
+def cached_response(etag_func):
+    """
+    Кеширует успешные GET-ответы в общем для воркеров файловом кеше.
+    Ключ строится из пути, query string и ETag, так что в нем уже есть версия импорта
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, import_id):
+            if request.method != 'GET' or not cache_enabled():
+                return view(request, import_id)
+            etag = etag_func(request, import_id)
+            if etag is None:
+                return view(request, import_id)
+            key = hashlib.sha1('{}?{}#{}'.format(request.path, request.META.get('QUERY_STRING', ''), etag)
+                               .encode('utf8')).hexdigest()
+            try:
+                content = fetch(import_id, key)
+            except OSError as e:
+                logger.debug("Can't read response cache. {}".format(e))
+                content = None
+            if content is not None:
+                return HttpResponse(content, status=200)
+
+            response = view(request, import_id)
+            if response.status_code == 200:
+                if response.streaming:
+                    response.streaming_content = tee(import_id, key, response.streaming_content)
+                elif len(response.content) <= settings.IMPORTS_RESPONSE_CACHE_MAX_ENTRY_SIZE:
+                    store(import_id, key, response.content)
+            return response
+        return wrapper
+    return decorator
+
+
+class DayCache:
+    """
+    LRU-кеш в памяти процесса для значений, зависящих от текущей UTC-даты. Со сменой даты
+    (при первом обращении после нее) кеш целиком сбрасывается. Размер в записях берется
+    из настройки size_setting, 0 - кеш выключен
+    """
+
+    def __init__(self, size_setting):
+        self.size_setting = size_setting
+        self.date = None
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_or_compute(self, key, today, compute):
+        max_size = getattr(settings, self.size_setting)
+        if not max_size:
+            return compute()
+        with self.lock:
+            if self.date != today:
+                self.items.clear()
+                self.date = today
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+        value = compute()
+        with self.lock:
+            if self.date == today:
+                self.items[key] = value
+                while len(self.items) > max_size:
+                    self.items.popitem(last=False)
+        return value
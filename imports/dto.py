@@ -1,4 +1,8 @@
 import json
+from functools import lru_cache
+
+
+CITIZEN_FIELDS = ('citizen_id', 'town', 'street', 'building', 'appartement', 'name', 'birth_date', 'gender', 'relatives')
 
 
 class DataResponse:
@@ -7,6 +11,30 @@ class DataResponse:
         self.data = data
 
 
+# Дат рождения в импорте намного меньше, чем жителей, поэтому strftime кешируем
+@lru_cache(maxsize=65536)
+def format_date(date):
+    return date.strftime('%d.%m.%Y')
+
+
+class CitizenRecord:
+    """
+    Провалидированные значения жителя, которые идут прямо в загрузчик без создания модели
+    """
+    __slots__ = ('citizen_id', 'town', 'street', 'building', 'appartement', 'name', 'birth_date', 'gender')
+
+    def __init__(self, citizen_id=None, town=None, street=None, building=None, appartement=None, name=None,
+                 birth_date=None, gender=None):
+        self.citizen_id = citizen_id
+        self.town = town
+        self.street = street
+        self.building = building
+        self.appartement = appartement
+        self.name = name
+        self.birth_date = birth_date
+        self.gender = gender
+
+
 class CitizenDTO:
     def __init__(self, citizen=None, relatives=None):
         self.citizen_id = citizen.citizen_id if citizen else None
@@ -15,7 +43,7 @@ class CitizenDTO:
         self.building = citizen.building if citizen else None
         self.appartement = citizen.appartement if citizen else None
         self.name = citizen.name if citizen else None
-        self.birth_date = citizen.birth_date.strftime('%d.%m.%Y') if citizen else None
+        self.birth_date = format_date(citizen.birth_date) if citizen else None
         self.gender = citizen.gender if citizen else None
         self.relatives = relatives if relatives is not None else [c.citizen_id for c in citizen.relatives.all()] if citizen else None
 
@@ -6,12 +6,24 @@ class ImportNotFound(Exception):
     def __init__(self, import_id):
         self.message = "Cannot find import with id - {}".format(import_id)
 
+#404
+class ImportJobNotFound(Exception):
+
+    def __init__(self, job_id):
+        self.message = "Cannot find import job with id - {}".format(job_id)
+
 #404
 class CitizenNotFound(Exception):
 
     def __init__(self, citizen_id):
         self.message = "Cannot find citizen with id - {}".format(citizen_id)
 
+# 415
+class UnsupportedContentEncoding(Exception):
+
+    def __init__(self, encoding):
+        self.message = "Unsupported Content-Encoding - {}. Must be gzip, deflate or identity".format(encoding)
+
 # 400
 class BadRelativesGiven(ValidationError):
 
@@ -0,0 +1,50 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction, connection, IntegrityError
+from django.utils import timezone
+
+from imports.models import ImportJob
+from imports.service import handle_add_import, handle_find_request
+
+logger = logging.getLogger(__name__)
+
+executor = None
+
+
+def get_executor():
+    # Пул создаем лениво, уже внутри воркера gunicorn, а не в мастере до форка
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=settings.IMPORTS_ASYNC_WORKERS, thread_name_prefix='imports')
+    return executor
+
+
+def submit_import(citizens, relatives, idempotency_key=None, digest=None):
+    job = ImportJob.objects.create()
+    # Фоновый поток должен увидеть уже закоммиченную задачу
+    transaction.on_commit(lambda: get_executor().submit(run_import_job, job.job_id, citizens, relatives,
+                                                        idempotency_key, digest))
+    return job
+
+
+def run_import_job(job_id, citizens, relatives, idempotency_key=None, digest=None):
+    try:
+        ImportJob.objects.filter(job_id=job_id).update(status=ImportJob.RUNNING, started_at=timezone.now())
+        try:
+            import_id = handle_add_import(citizens, relatives, idempotency_key, digest)['import_id']
+        except IntegrityError:
+            previous = handle_find_request(idempotency_key) if idempotency_key is not None else None
+            if previous is None:
+                raise
+            if previous[1] != digest:
+                raise ValueError("Idempotency-Key already used with another request body")
+            import_id = previous[0]
+        ImportJob.objects.filter(job_id=job_id).update(status=ImportJob.DONE, import_id=import_id)
+        logger.debug("Import job {} finished. Import_id - {}".format(job_id, import_id))
+    except Exception as e:
+        logger.exception("Import job {} failed".format(job_id))
+        ImportJob.objects.filter(job_id=job_id).update(status=ImportJob.FAILED, error=str(e))
+    finally:
+        connection.close()
@@ -0,0 +1,165 @@
+import io
+import struct
+from functools import partial
+
+from imports.models import Citizen
+
+ROWS_PER_CHUNK = 1000
+PG_EPOCH_ORDINAL = 730120  # date(2000, 1, 1).toordinal()
+BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+BINARY_TRAILER = struct.pack('!h', -1)
+
+citizen_fields = ['"{}"'.format(field.column) for field in Citizen._meta.fields]
+relatives_table = Citizen.relatives.through._meta.db_table
+relative_row = struct.Struct('!hiiii')
+int_field = struct.Struct('!ii')
+text_length = struct.Struct('!i')
+citizen_row_header = struct.Struct('!h')
+
+
+class IteratorReader(io.RawIOBase):
+    """
+    Файлоподобная обертка над генератором байтовых чанков для copy_expert,
+    чтобы COPY не требовал собирать все данные в памяти
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.leftover = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.leftover:
+            try:
+                self.leftover = next(self.chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self.leftover))
+        buffer[:size] = self.leftover[:size]
+        self.leftover = self.leftover[size:]
+        return size
+
+
+def citizen_values(import_id, citizen):
+    return (import_id, citizen.citizen_id, citizen.town, citizen.street, citizen.building,
+            citizen.appartement, citizen.name, citizen.birth_date, citizen.gender)
+
+
+def citizen_rows(import_id, db_ids, citizens):
+    for db_id, citizen in zip(db_ids, citizens):
+        yield (db_id,) + citizen_values(import_id, citizen)
+
+
+def escape_text(value):
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def text_citizen_chunks(rows):
+    lines = []
+    for db_id, import_id, citizen_id, town, street, building, appartement, name, birth_date, gender in rows:
+        lines.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(
+            db_id, import_id, citizen_id, escape_text(town), escape_text(street), escape_text(building),
+            appartement, escape_text(name), birth_date.isoformat(), escape_text(gender)))
+        if len(lines) == ROWS_PER_CHUNK:
+            yield ''.join(lines).encode('utf8')
+            lines = []
+    if lines:
+        yield ''.join(lines).encode('utf8')
+
+
+def binary_text(value):
+    value = value.encode('utf8')
+    return text_length.pack(len(value)) + value
+
+
+def binary_citizen_chunks(rows):
+    yield BINARY_HEADER
+    chunk = []
+    for db_id, import_id, citizen_id, town, street, building, appartement, name, birth_date, gender in rows:
+        chunk.append(b''.join((citizen_row_header.pack(10),
+                               int_field.pack(4, db_id),
+                               int_field.pack(4, import_id),
+                               int_field.pack(4, citizen_id),
+                               binary_text(town),
+                               binary_text(street),
+                               binary_text(building),
+                               int_field.pack(4, appartement),
+                               binary_text(name),
+                               int_field.pack(4, birth_date.toordinal() - PG_EPOCH_ORDINAL),
+                               binary_text(gender))))
+        if len(chunk) == ROWS_PER_CHUNK:
+            yield b''.join(chunk)
+            chunk = []
+    chunk.append(BINARY_TRAILER)
+    yield b''.join(chunk)
+
+
+def text_relative_chunks(edges):
+    lines = []
+    for from_id, to_id in edges:
+        lines.append('{}\t{}\n'.format(from_id, to_id))
+        if len(lines) == ROWS_PER_CHUNK:
+            yield ''.join(lines).encode('ascii')
+            lines = []
+    if lines:
+        yield ''.join(lines).encode('ascii')
+
+
+def binary_relative_chunks(edges):
+    yield BINARY_HEADER
+    chunk = []
+    for from_id, to_id in edges:
+        chunk.append(relative_row.pack(2, 4, from_id, 4, to_id))
+        if len(chunk) == ROWS_PER_CHUNK:
+            yield b''.join(chunk)
+            chunk = []
+    chunk.append(BINARY_TRAILER)
+    yield b''.join(chunk)
+
+
+def copy(cursor, table, fields, chunks, binary):
+    sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT {})'.format(table, ','.join(fields), 'binary' if binary else 'text')
+    # copy_expert есть только у курсора psycopg2, джанговский курсор его не проксирует
+    cursor.cursor.copy_expert(sql, IteratorReader(chunks))
+
+
+def insert_citizens(cursor, import_id, citizens):
+    fields = citizen_fields[1:]
+    placeholders = ",".join(['({})'.format(','.join(['%s'] * len(fields)))] * len(citizens))
+    sql = 'insert into {} ({}) VALUES {} RETURNING "id", "citizen_id"'.format(Citizen._meta.db_table, ','.join(fields), placeholders)
+    models_values = [field_value for citizen in citizens for field_value in citizen_values(import_id, citizen)]
+    cursor.execute(sql, models_values)
+    return {citizen_id: db_cit_id for db_cit_id, citizen_id in cursor.fetchall()}
+
+
+def insert_relatives(cursor, edges):
+    models_values = [db_id for edge in edges for db_id in edge]
+    if len(models_values) > 0:
+        placeholders = ",".join(["(%s, %s)"] * (len(models_values) // 2))
+        sql = "insert into {} (from_citizen_id, to_citizen_id) VALUES {}".format(relatives_table, placeholders)
+        cursor.execute(sql, models_values)
+
+
+def copy_citizens(cursor, import_id, citizens, binary=False):
+    # COPY не умеет RETURNING, поэтому первичные ключи забираем из последовательности заранее
+    cursor.execute("select nextval(pg_get_serial_sequence(%s, 'id')) from generate_series(1, %s)",
+                   [Citizen._meta.db_table, len(citizens)])
+    db_ids = [db_id for db_id, in cursor.fetchall()]
+    rows = citizen_rows(import_id, db_ids, citizens)
+    chunks = binary_citizen_chunks(rows) if binary else text_citizen_chunks(rows)
+    copy(cursor, Citizen._meta.db_table, citizen_fields, chunks, binary)
+    return {citizen.citizen_id: db_id for db_id, citizen in zip(db_ids, citizens)}
+
+
+def copy_relatives(cursor, edges, binary=False):
+    chunks = binary_relative_chunks(edges) if binary else text_relative_chunks(edges)
+    copy(cursor, relatives_table, ['from_citizen_id', 'to_citizen_id'], chunks, binary)
+
+
+LOADERS = {
+    'insert': (insert_citizens, insert_relatives),
+    'copy_text': (copy_citizens, copy_relatives),
+    'copy_binary': (partial(copy_citizens, binary=True), partial(copy_relatives, binary=True)),
+}
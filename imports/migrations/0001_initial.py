@@ -0,0 +1,89 @@
+# Generated by Django 2.2 on 2026-10-18 14:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Import',
+            fields=[
+                ('import_id', models.AutoField(primary_key=True, serialize=False)),
+                ('version', models.IntegerField(default=0)),
+                ('birthdays_ready', models.BooleanField(default=False)),
+                ('towns_ready', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ImportRequest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=256, null=True, unique=True)),
+                ('digest', models.CharField(db_index=True, max_length=64)),
+                ('import_id', models.ForeignKey(db_column='import_id', on_delete=django.db.models.deletion.CASCADE, to='imports.Import')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('job_id', models.AutoField(primary_key=True, serialize=False)),
+                ('status', models.CharField(default='pending', max_length=16)),
+                ('error', models.TextField(null=True)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('import_id', models.ForeignKey(db_column='import_id', null=True, on_delete=django.db.models.deletion.SET_NULL, to='imports.Import')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TownBirthDates',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('town', models.CharField(max_length=256)),
+                ('birth_date', models.DateField()),
+                ('citizens', models.IntegerField()),
+                ('import_id', models.ForeignKey(db_column='import_id', on_delete=django.db.models.deletion.CASCADE, to='imports.Import')),
+            ],
+            options={
+                'unique_together': {('import_id', 'town', 'birth_date')},
+            },
+        ),
+        migrations.CreateModel(
+            name='Citizen',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('citizen_id', models.IntegerField()),
+                ('town', models.CharField(max_length=256)),
+                ('street', models.CharField(max_length=256)),
+                ('building', models.CharField(max_length=256)),
+                ('appartement', models.IntegerField()),
+                ('name', models.CharField(max_length=256)),
+                ('birth_date', models.DateField()),
+                ('gender', models.CharField(max_length=16)),
+                ('import_id', models.ForeignKey(db_column='import_id', on_delete=django.db.models.deletion.CASCADE, to='imports.Import')),
+                ('relatives', models.ManyToManyField(related_name='_citizen_relatives_+', to='imports.Citizen')),
+            ],
+            options={
+                'unique_together': {('import_id', 'citizen_id')},
+            },
+        ),
+        migrations.CreateModel(
+            name='BirthdayPresents',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('citizen_id', models.IntegerField()),
+                ('month', models.SmallIntegerField()),
+                ('presents', models.IntegerField()),
+                ('import_id', models.ForeignKey(db_column='import_id', on_delete=django.db.models.deletion.CASCADE, to='imports.Import')),
+            ],
+            options={
+                'unique_together': {('import_id', 'month', 'citizen_id')},
+            },
+        ),
+    ]
@@ -1,8 +1,24 @@
 from django.db import models
+from django.utils import timezone
+
+from imports import cache
 
 
 class Import(models.Model):
     import_id = models.AutoField(primary_key=True)
+    # Растет на каждое изменение жителей импорта, отдается клиентам как ETag
+    version = models.IntegerField(default=0)
+    # Посчитан ли для импорта агрегат BirthdayPresents (для старых импортов строится при первом чтении)
+    birthdays_ready = models.BooleanField(default=False)
+    # То же для гистограммы TownBirthDates
+    towns_ready = models.BooleanField(default=False)
+
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+        super().save(*args, **kwargs)
+        # id мог достаться от импорта из пересозданной базы - старые ответы из кеша ему не подходят
+        if created and cache.cache_enabled():
+            cache.invalidate(self.import_id)
 
 
 class Citizen(models.Model):
@@ -18,8 +34,54 @@ class Citizen(models.Model):
 
     relatives = models.ManyToManyField(to='self', symmetrical=True)
 
-    def get_insert_values(self):
-        return self.import_id.import_id, self.citizen_id, self.town, self.street, self.building, self.appartement, self.name, self.birth_date.strftime('%Y-%m-%d'), self.gender
-
     class Meta:
         unique_together = (('import_id', 'citizen_id'),)
+
+
+class BirthdayPresents(models.Model):
+    """
+    Сколько подарков житель покупает родственникам в каждом месяце. Поддерживается
+    инкрементально при PATCH, поэтому строки с нулем не удаляются, а отфильтровываются при чтении
+    """
+    import_id = models.ForeignKey(to=Import, db_column='import_id', on_delete=models.CASCADE)
+    citizen_id = models.IntegerField()
+    month = models.SmallIntegerField()
+    presents = models.IntegerField()
+
+    class Meta:
+        unique_together = (('import_id', 'month', 'citizen_id'),)
+
+
+class TownBirthDates(models.Model):
+    """
+    Сколько жителей города родилось в каждую дату. Дат намного меньше, чем жителей,
+    а возраст по дате пересчитывается на день запроса
+    """
+    import_id = models.ForeignKey(to=Import, db_column='import_id', on_delete=models.CASCADE)
+    town = models.CharField(max_length=256)
+    birth_date = models.DateField()
+    citizens = models.IntegerField()
+
+    class Meta:
+        unique_together = (('import_id', 'town', 'birth_date'),)
+
+
+class ImportJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    job_id = models.AutoField(primary_key=True)
+    status = models.CharField(max_length=16, default=PENDING)
+    import_id = models.ForeignKey(to=Import, db_column='import_id', null=True, on_delete=models.SET_NULL)
+    error = models.TextField(null=True)
+    # Время постановки в очередь, а после старта - время запуска. По нему находятся задачи,
+    # потерянные вместе с воркером
+    started_at = models.DateTimeField(default=timezone.now)
+
+
+class ImportRequest(models.Model):
+    key = models.CharField(max_length=256, unique=True, null=True)
+    digest = models.CharField(max_length=64, db_index=True)
+    import_id = models.ForeignKey(to=Import, db_column='import_id', on_delete=models.CASCADE)
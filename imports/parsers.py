@@ -0,0 +1,236 @@
+import codecs
+import hashlib
+import json
+import zlib
+from json import JSONDecodeError
+
+from django.conf import settings
+from django.core.exceptions import ValidationError, RequestDataTooBig
+
+from imports.exceptions import UnsupportedContentEncoding
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+# Самый длинный токен JSON без кавычек - '-Infinity'
+MAX_TOKEN = len('-Infinity')
+
+
+def body_stream(request):
+    # Тело запроса читаем потоком из wsgi.input, поэтому проверку размера,
+    # которую Django делает в request.body, приходится делать самим
+    max_size = settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+    if max_size is not None and int(request.META.get('CONTENT_LENGTH') or 0) > max_size:
+        raise RequestDataTooBig('Request body exceeded settings.DATA_UPLOAD_MAX_MEMORY_SIZE.')
+    encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        return HashingReader(DecompressingReader(request, encoding, settings.IMPORTS_MAX_DECOMPRESSED_SIZE))
+    if encoding not in ('', 'identity'):
+        raise UnsupportedContentEncoding(encoding)
+    return HashingReader(request)
+
+
+class DecompressingReader:
+    """
+    Потоково распаковывает тело с Content-Encoding gzip/deflate. За один read распаковывается
+    не больше запрошенного, а суммарный размер ограничен max_size - защита от zip-бомб
+    """
+
+    def __init__(self, stream, encoding, max_size):
+        self.stream = stream
+        self.encoding = encoding
+        self.max_size = max_size
+        self.decompressor = None
+        self.size = 0
+
+    def create_decompressor(self, head):
+        if self.encoding != 'deflate':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # По RFC deflate - это zlib-поток, но часть клиентов шлет "сырой" deflate без заголовка
+        is_zlib = len(head) >= 2 and head[0] & 0x0f == 8 and (head[0] * 256 + head[1]) % 31 == 0
+        return zlib.decompressobj(zlib.MAX_WBITS if is_zlib else -zlib.MAX_WBITS)
+
+    def read(self, size=None):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(CHUNK_SIZE), b''))
+        try:
+            data = self.decompress(size)
+        except zlib.error as e:
+            raise ValueError("Can't decompress request body. {}".format(e))
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestDataTooBig('Decompressed request body exceeded settings.IMPORTS_MAX_DECOMPRESSED_SIZE.')
+        return data
+
+    def decompress(self, size):
+        while True:
+            if self.decompressor is not None and self.decompressor.unconsumed_tail:
+                data = self.decompressor.decompress(self.decompressor.unconsumed_tail, size)
+            else:
+                compressed = self.stream.read(CHUNK_SIZE)
+                if self.decompressor is None:
+                    self.decompressor = self.create_decompressor(compressed)
+                if not compressed:
+                    if not self.decompressor.eof:
+                        raise ValueError("Compressed request body is truncated")
+                    return b''
+                data = self.decompressor.decompress(compressed, size)
+            if data or self.decompressor.eof and not self.decompressor.unconsumed_tail:
+                return data
+
+
+class HashingReader:
+    """
+    Считает sha256 от тела по мере чтения, чтобы распознавать повторную отправку того же импорта
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+
+    def read(self, size=None):
+        # LimitedStream джанги не понимает size=-1, поэтому "прочитать все" передаем как read()
+        chunk = self.stream.read() if size is None or size < 0 else self.stream.read(size)
+        self.hash.update(chunk)
+        return chunk
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class JsonStreamReader:
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf8')()
+        self.raw_decode = json.JSONDecoder().raw_decode
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        # Читаем не меньше, чем уже накоплено, чтобы повторный разбор
+        # длинного значения обходился в O(n), а не в O(n^2)
+        pending = len(self.buffer) - self.pos
+        chunk = self.stream.read(max(self.chunk_size, pending))
+        if not chunk:
+            self.eof = True
+        text = self.decoder.decode(chunk, final=self.eof)
+        if self.pos > self.chunk_size:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += text
+        return not self.eof
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char, message):
+        if self.peek() != char:
+            raise JSONDecodeError(message, self.buffer, self.pos)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.raw_decode(self.buffer, self.pos)
+            except JSONDecodeError as e:
+                # Дочитываем, только если значение оборвано концом буфера, иначе ошибка в самих данных
+                if not self.incomplete(e) or not self.fill():
+                    raise
+                continue
+            # Число на границе чанка могло быть прочитано не полностью
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def incomplete(self, error):
+        # Незакрытая строка доходит до конца буфера по определению. Оборванные литерал, число
+        # или \uXXXX-последовательность парсер отмечает в их начале - не дальше MAX_TOKEN от конца
+        return error.msg.startswith('Unterminated string') or len(self.buffer) - error.pos <= MAX_TOKEN
+
+
+def iter_citizens(stream, chunk_size=CHUNK_SIZE):
+    """
+    Потоково разбирает тело вида {"citizens": [...]} и отдает жителей по одному,
+    не держа в памяти ни тело запроса целиком, ни готовый список жителей
+    """
+    reader = JsonStreamReader(stream, chunk_size)
+    if reader.peek() != '{':
+        reader.value()
+        raise ValidationError("Request body is not json object")
+    reader.pos += 1
+
+    citizens_found = False
+    if reader.peek() != '}':
+        while True:
+            if reader.peek() != '"':
+                raise JSONDecodeError("Expecting property name enclosed in double quotes", reader.buffer, reader.pos)
+            key = reader.value()
+            reader.expect(':', "Expecting ':' delimiter")
+            if key == 'citizens':
+                if citizens_found:
+                    raise ValidationError("Duplicate citizens key in incoming json")
+                citizens_found = True
+                yield from iter_array(reader)
+            else:
+                reader.value()
+            if reader.peek() == ',':
+                reader.pos += 1
+                continue
+            reader.expect('}', "Expecting ',' delimiter")
+            break
+    else:
+        reader.pos += 1
+
+    if reader.peek() != '':
+        raise JSONDecodeError("Extra data", reader.buffer, reader.pos)
+    if not citizens_found:
+        raise ValidationError("No found citizens key in incoming json")
+
+
+def iter_array(reader):
+    if reader.peek() != '[':
+        reader.value()
+        raise ValidationError("No citizens provided or they are not in list")
+    reader.pos += 1
+    if reader.peek() == ']':
+        raise ValidationError("No citizens provided or they are not in list")
+    while True:
+        yield reader.value()
+        if reader.peek() == ',':
+            reader.pos += 1
+            continue
+        reader.expect(']', "Expecting ',' delimiter")
+        return
+
+
+def iter_ndjson_citizens(stream, chunk_size=CHUNK_SIZE):
+    """
+    Разбирает тело в формате NDJSON, где каждая непустая строка - один житель
+    """
+    decoder = codecs.getincrementaldecoder('utf8')()
+    tail = ''
+    citizens_found = False
+    while True:
+        chunk = stream.read(chunk_size)
+        lines = (tail + decoder.decode(chunk, final=not chunk)).split('\n')
+        tail = lines.pop() if chunk else ''
+        for line in lines:
+            if line.strip():
+                citizens_found = True
+                yield json.loads(line)
+        if not chunk:
+            break
+    if not citizens_found:
+        raise ValidationError("No citizens provided")
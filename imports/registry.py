@@ -0,0 +1,123 @@
+import threading
+from collections import OrderedDict
+
+import numpy
+from django.conf import settings
+from django.db import connection, transaction
+
+
+class CitizenMap:
+    """
+    Неизменяемая карта citizen_id -> pk одного импорта: два массива int32 (как и колонки в базе),
+    отсортированных по citizen_id, - 8 байт на жителя
+    """
+    __slots__ = ('citizen_ids', 'pks')
+
+    def __init__(self, citizen_ids, pks):
+        citizen_ids = numpy.asarray(citizen_ids, dtype=numpy.int32)
+        order = numpy.argsort(citizen_ids, kind='stable')
+        self.citizen_ids = citizen_ids[order]
+        self.pks = numpy.asarray(pks, dtype=numpy.int32)[order]
+
+    def __len__(self):
+        return len(self.citizen_ids)
+
+    def resolve(self, citizen_ids):
+        # pk в порядке citizen_ids или None, если кого-то из жителей в импорте нет
+        if not len(citizen_ids):
+            return []
+        if not len(self.citizen_ids):
+            return None
+        try:
+            ids = numpy.asarray(citizen_ids, dtype=numpy.int64)
+        except OverflowError:
+            return None
+        positions = numpy.minimum(numpy.searchsorted(self.citizen_ids, ids), len(self.citizen_ids) - 1)
+        if not (self.citizen_ids[positions] == ids).all():
+            return None
+        return self.pks[positions].tolist()
+
+
+class ImportRegistry:
+    """
+    Известные воркеру импорты и их карты citizen_id -> pk. Импорты не удаляются, а набор жителей
+    импорта не меняется после загрузки, поэтому сбрасывать записи не нужно - только вытеснять по LRU.
+    Запоминается только закоммиченное: внутри транзакции запись откладывается до коммита
+    """
+
+    def __init__(self, size_setting):
+        self.size_setting = size_setting
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return bool(getattr(settings, self.size_setting))
+
+    @staticmethod
+    def key(import_id):
+        return connection.settings_dict['NAME'], import_id
+
+    def get(self, import_id):
+        if not self.enabled():
+            return False, None
+        key = self.key(import_id)
+        with self.lock:
+            if key not in self.items:
+                return False, None
+            self.items.move_to_end(key)
+            return True, self.items[key]
+
+    def exists(self, import_id):
+        return self.get(import_id)[0]
+
+    def citizen_map(self, import_id):
+        """
+        Карта жителей импорта, при промахе - одним запросом. None, если такого импорта нет
+        """
+        if not self.enabled():
+            return None
+        citizen_map = self.get(import_id)[1]
+        if citizen_map is not None:
+            return citizen_map
+        with connection.cursor() as cur:
+            cur.execute('select c.citizen_id, c.id from imports_import i '
+                        'left join imports_citizen c on c.import_id = i.import_id where i.import_id = %s',
+                        [import_id])
+            rows = cur.fetchall()
+        if not rows:
+            return None
+        rows = [row for row in rows if row[0] is not None]
+        citizen_map = CitizenMap([row[0] for row in rows], [row[1] for row in rows])
+        self.add(import_id, citizen_map)
+        return citizen_map
+
+    def add(self, import_id, citizen_map=None):
+        if self.enabled():
+            key = self.key(import_id)
+            transaction.on_commit(lambda: self.store(key, citizen_map))
+
+    def store(self, key, citizen_map):
+        max_size = getattr(settings, self.size_setting)
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                if citizen_map is None:
+                    return
+                self.size -= self.cost(self.items[key])
+            self.items[key] = citizen_map
+            self.items.move_to_end(key)
+            self.size += self.cost(citizen_map)
+            while self.size > max_size and self.items:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= self.cost(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    @staticmethod
+    def cost(citizen_map):
+        return 1 if citizen_map is None else max(len(citizen_map), 1)
+
@@ -0,0 +1,108 @@
+from functools import lru_cache
+from json.encoder import encode_basestring
+
+from django.core.exceptions import ValidationError
+
+from imports.dto import format_date, CITIZEN_FIELDS
+
+citizen_template = '{{"citizen_id": {}, "town": {}, "street": {}, "building": {}, "appartement": {}, ' \
+                   '"name": {}, "birth_date": {}, "gender": {}, "relatives": [{}]}}'
+
+
+def dump_citizen(citizen):
+    """
+    Сериализует CitizenDTO в байты, совпадающие с json.dumps(..., cls=CitizenDTOEncoder, ensure_ascii=False)
+    """
+    return citizen_template.format(citizen.citizen_id,
+                                   encode_basestring(citizen.town),
+                                   encode_basestring(citizen.street),
+                                   encode_basestring(citizen.building),
+                                   citizen.appartement,
+                                   encode_basestring(citizen.name),
+                                   encode_basestring(citizen.birth_date),
+                                   encode_basestring(citizen.gender),
+                                   ', '.join(map(str, citizen.relatives))).encode('utf8')
+
+
+def dump_citizen_row(row):
+    citizen_id, town, street, building, appartement, name, birth_date, gender, relatives = row
+    return citizen_template.format(citizen_id,
+                                   encode_basestring(town),
+                                   encode_basestring(street),
+                                   encode_basestring(building),
+                                   appartement,
+                                   encode_basestring(name),
+                                   encode_basestring(format_date(birth_date)),
+                                   encode_basestring(gender),
+                                   ', '.join(map(str, relatives))).encode('utf8')
+
+
+field_encoders = {
+    'citizen_id': str,
+    'town': encode_basestring,
+    'street': encode_basestring,
+    'building': encode_basestring,
+    'appartement': str,
+    'name': encode_basestring,
+    'birth_date': lambda birth_date: encode_basestring(format_date(birth_date)),
+    'gender': encode_basestring,
+    'relatives': lambda relatives: '[' + ', '.join(map(str, relatives)) + ']',
+}
+
+
+def parse_fields(value):
+    """
+    Разбирает ?fields=town,birth_date в кортеж полей в каноническом порядке
+    """
+    if value is None:
+        return None
+    fields = {field.strip() for field in value.split(',')} - {''}
+    if not fields:
+        raise ValidationError("fields must not be empty")
+    unknown = fields.difference(CITIZEN_FIELDS)
+    if unknown:
+        raise ValidationError("Unknown fields - {}".format(', '.join(sorted(unknown))))
+    return tuple(field for field in CITIZEN_FIELDS if field in fields)
+
+
+@lru_cache(maxsize=512)
+def make_citizen_row_dumper(fields):
+    """
+    Сериализатор строки выборки citizens_projection_sql(fields): первая колонка - курсор, дальше поля по порядку
+    """
+    template = '{{' + ', '.join('"{}": {{}}'.format(field) for field in fields) + '}}'
+    encoders = [field_encoders[field] for field in fields]
+
+    def dump(row):
+        return template.format(*[encode(value) for encode, value in zip(encoders, row[1:])]).encode('utf8')
+    return dump
+
+
+def relay_citizen_json(row):
+    # JSON жителя уже собран в Postgres, остается только отдать байты
+    return row[1]
+
+
+def dump_citizen_response(citizen):
+    return b'{"data": ' + dump_citizen(citizen) + b'}'
+
+
+def dump_citizens_response(citizens):
+    return b'{"data": [' + b', '.join(map(dump_citizen, citizens)) + b']}'
+
+
+def dump_citizens_page(rows, next_cursor, dump_row=dump_citizen_row):
+    return b'{"data": [' + b', '.join(map(dump_row, rows)) + b'], "next_cursor": ' + \
+        (b'null' if next_cursor is None else str(next_cursor).encode()) + b'}'
+
+
+def iter_citizens_response(row_chunks, dump_row=dump_citizen_row):
+    """
+    Отдает ответ со списком жителей по частям, по одной на каждую пачку строк из курсора
+    """
+    yield b'{"data": ['
+    separator = b''
+    for rows in row_chunks:
+        yield separator + b', '.join(map(dump_row, rows))
+        separator = b', '
+    yield b']}'
@@ -1,81 +1,339 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import numpy
+from django.conf import settings
 from django.db import transaction, connection
+from django.utils import timezone
 
-from imports.dto import CitizenDTO
-from imports.exceptions import ImportNotFound, CitizenNotFound, RelativesNotFound
-from imports.models import Import, Citizen
+from imports import cache
+from imports.aggregates import birthdays_sql, build_birthdays, count_birthdays, birthday_deltas, birthday_upsert, \
+    edges_birthday_deltas, apply_birthday_deltas, build_town_birth_dates, count_town_birth_dates, town_upsert, \
+    apply_town_deltas, percentiles_from_counts
+from imports.dto import CitizenDTO, CitizenRecord, CITIZEN_FIELDS
+from imports.exceptions import ImportNotFound, CitizenNotFound, RelativesNotFound, ImportJobNotFound
+from imports.loaders import LOADERS
+from imports.models import Import, Citizen, ImportJob, ImportRequest
+from imports.registry import ImportRegistry, CitizenMap
+
+percentile_cache = cache.DayCache('IMPORTS_PERCENTILE_CACHE_SIZE')
+import_registry = ImportRegistry('IMPORTS_REGISTRY_SIZE')
+
+
+def handle_find_import(idempotency_key=None, digest=None):
+    requests = ImportRequest.objects.filter(key=idempotency_key) if idempotency_key is not None \
+        else ImportRequest.objects.filter(digest=digest)
+    import_id = requests.values_list('import_id', flat=True).first()
+    return {'import_id': import_id} if import_id is not None else None
+
+
+def handle_find_request(idempotency_key):
+    # import_id и sha256 тела, с которыми уже был выполнен импорт по этому ключу
+    return ImportRequest.objects.filter(key=idempotency_key).values_list('import_id', 'digest').first()
 
 
 @transaction.atomic
-def handle_add_import(citizens, relatives):
-    new_import = Import()
+def handle_add_import(citizens, relatives, idempotency_key=None, digest=None):
+    new_import = Import(birthdays_ready=True, towns_ready=True)
     Import.save(new_import)
-    for citizen in citizens:
-        citizen.import_id = new_import
+    if idempotency_key is not None or digest is not None:
+        # Запись делаем до загрузки жителей: параллельный повтор с тем же ключом упадет
+        # на уникальном индексе сразу, а не после вставки всех строк
+        ImportRequest.objects.create(key=idempotency_key, digest=digest, import_id=new_import)
 
     if len(citizens) > 0:
         cur = connection.cursor()
-        fields = ['"{}"'.format(field.name) for field in Citizen._meta.fields][1:]
-        placeholders = ",".join(['({})'.format(','.join(['%s']*len(fields)))]*len(citizens))
-        sql = 'insert into {} ({}) VALUES {} RETURNING "id", "citizen_id"'.format(Citizen._meta.db_table, ','.join(fields), placeholders)
-        models_values = [field_value for citizen in citizens for field_value in citizen.get_insert_values()]
-        cur.execute(sql, models_values)
-
-        db_citizen_ids_map = {citizen_id: db_cit_id for db_cit_id, citizen_id in cur.fetchall()}
-
-        placeholders_len = 0
-        models_values = []
-        for citizen_id, relative in relatives.items():
-            placeholders_len += len(relative)
-            for rel_id in relative:
-                models_values.append(db_citizen_ids_map[citizen_id])
-                models_values.append(db_citizen_ids_map[rel_id])
-        if placeholders_len > 0:
-            placeholders = ",".join(["(%s, %s)"]*placeholders_len)
-            sql = "insert into imports_citizen_relatives (from_citizen_id, to_citizen_id) VALUES {}".format(placeholders)
-            cur.execute(sql, models_values)
+        load_citizens, load_relatives = LOADERS[settings.IMPORTS_LOADER]
+        db_citizen_ids_map = load_citizens(cur, new_import.import_id, citizens)
+        apply_town_deltas(cur, new_import.import_id, count_town_birth_dates(citizens))
+
+        if sum(len(relative) for relative in relatives.values()) > 0:
+            edges = ((db_citizen_ids_map[citizen_id], db_citizen_ids_map[rel_id])
+                     for citizen_id, relative in relatives.items()
+                     for rel_id in relative)
+            load_relatives(cur, edges)
+            apply_birthday_deltas(cur, new_import.import_id, count_birthdays(citizens, relatives))
+        citizen_map = CitizenMap(list(db_citizen_ids_map.keys()), list(db_citizen_ids_map.values()))
+    else:
+        citizen_map = CitizenMap([], [])
+    import_registry.add(new_import.import_id, citizen_map)
 
     return {'import_id': new_import.import_id}
 
 
+def handle_get_job(job_id):
+    # Задачи живут в пуле потоков воркера и пропадают вместе с ним (таймаут, max_requests, деплой),
+    # поэтому слишком долгую задачу отдаем как failed. Если она все же доработает, статус станет done
+    ImportJob.objects.filter(job_id=job_id, status__in=(ImportJob.PENDING, ImportJob.RUNNING),
+                             started_at__lt=timezone.now() - timedelta(seconds=settings.IMPORTS_ASYNC_JOB_TIMEOUT)) \
+        .update(status=ImportJob.FAILED, error="Import job was lost or timed out")
+    try:
+        job = ImportJob.objects.only('status', 'import_id', 'error').get(job_id=job_id)
+    except ImportJob.DoesNotExist:
+        raise ImportJobNotFound(job_id)
+    return {'job_id': job.job_id, 'status': job.status, 'import_id': job.import_id_id, 'error': job.error}
+
+
+# Первый из двух запросов PATCH: поднимает версию импорта (и блокирует его строку до конца транзакции),
+# блокирует жителя и возвращает его вместе со старыми и новыми родственниками в виде [id, citizen_id, месяц]
+change_citizen_read_sql = \
+    'with imp as (update imports_import set version = version + 1 where import_id = %s ' \
+    'returning birthdays_ready, towns_ready), ' \
+    'cit as (select id, town, street, building, appartement, name, birth_date, gender from imports_citizen ' \
+    'where import_id = %s and citizen_id = %s for update) ' \
+    'select imp.birthdays_ready, imp.towns_ready, cit.*, ' \
+    'array(select array[r.id, r.citizen_id, extract(month from r.birth_date)::int] ' \
+    'from imports_citizen_relatives cr, imports_citizen r where cr.from_citizen_id = cit.id and r.id = cr.to_citizen_id), ' \
+    'array(select array[r.id, r.citizen_id, extract(month from r.birth_date)::int] ' \
+    'from imports_citizen r where r.import_id = %s and r.citizen_id = any(%s::int[])) ' \
+    'from imp left join cit on true'
+
+citizen_update_fields = ('town', 'street', 'building', 'appartement', 'name', 'birth_date', 'gender')
+# citizen_id в базе - int4: жителей с id вне его диапазона в импорте нет, а приведение к int[] на них падает.
+# Поэтому такие id в запрос не передаем - он их просто не находит, и ошибка та же, что для любого чужого id
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+def int32_or_none(citizen_id):
+    return citizen_id if INT32_MIN <= citizen_id <= INT32_MAX else None
+
+
+def int32_only(citizen_ids):
+    return [citizen_id for citizen_id in citizen_ids if INT32_MIN <= citizen_id <= INT32_MAX]
+
+
 @transaction.atomic
 def handle_change_citizen(import_id, citizen_id, new_citizen_info, new_relatives):
-    if not Import.objects.filter(import_id=import_id).exists():
+    """
+    PATCH за два запроса: чтение с блокировками и одна CTE со всеми изменениями -
+    полями жителя, симметричными связями и агрегатами. Ответ собирается без перечитывания
+    """
+    # Родственников чтение ниже и так разрешает тем же запросом, поэтому карту жителей берем, только если она уже есть:
+    # с ней ошибочный PATCH отклоняется до первого запроса к базе
+    citizen_map = import_registry.get(import_id)[1]
+    if citizen_map is not None:
+        if citizen_map.resolve([citizen_id]) is None:
+            raise CitizenNotFound(citizen_id)
+        if new_relatives is not None and citizen_map.resolve(new_relatives) is None:
+            raise RelativesNotFound()
+    cur = connection.cursor()
+    cur.execute(change_citizen_read_sql, [import_id, import_id, int32_or_none(citizen_id), import_id,
+                                          None if new_relatives is None else int32_only(new_relatives)])
+    row = cur.fetchone()
+    if row is None:
         raise ImportNotFound(import_id)
-    try:
-        citizen = Citizen.objects.get(citizen_id=citizen_id, import_id=import_id)
-    except Citizen.DoesNotExist:
+    birthdays_ready, towns_ready, pk = row[:3]
+    if pk is None:
         raise CitizenNotFound(citizen_id)
+    old_citizen = CitizenRecord(citizen_id, *row[3:10])
+    old_relatives, found_relatives = row[10:]
+    # Ответы старой версии уже не отдаются (версия входит в ключ кеша), место под них освобождаем после коммита
+    if cache.cache_enabled():
+        transaction.on_commit(lambda: cache.invalidate(import_id))
+    if new_relatives is not None and len(found_relatives) != len(new_relatives):
+        raise RelativesNotFound()
+
+    changes = []
+    params = []
+    updated = [(field, getattr(new_citizen_info, field)) for field in citizen_update_fields
+               if getattr(new_citizen_info, field) is not None]
+    citizen = CitizenRecord(citizen_id, **{field: getattr(old_citizen, field) for field in citizen_update_fields})
+    if updated:
+        changes.append('upd as (update imports_citizen set {} where id = %s)'.format(
+            ', '.join('{} = %s'.format(field) for field, _ in updated)))
+        params += [value for _, value in updated] + [pk]
+        for field, value in updated:
+            setattr(citizen, field, value)
+
+    relatives = old_relatives
     if new_relatives is not None:
-        relative_citizens = Citizen.objects.filter(import_id=import_id, citizen_id__in=new_relatives)
-        if relative_citizens.count() != len(new_relatives):
-            raise RelativesNotFound()
-        citizen.relatives.set(relative_citizens)
-
-    if new_citizen_info.town:
-        citizen.town = new_citizen_info.town
-    if new_citizen_info.street:
-        citizen.street = new_citizen_info.street
-    if new_citizen_info.building:
-        citizen.building = new_citizen_info.building
-    if new_citizen_info.appartement is not None:
-        citizen.appartement = new_citizen_info.appartement
-    if new_citizen_info.name:
-        citizen.name = new_citizen_info.name
-    if new_citizen_info.birth_date:
-        citizen.birth_date = new_citizen_info.birth_date
-    if new_citizen_info.gender:
-        citizen.gender = new_citizen_info.gender
-    citizen.save()
-    return CitizenDTO(citizen)
+        old_ids = {rel[0] for rel in old_relatives}
+        new_ids = {rel[0] for rel in found_relatives}
+        removed, added = list(old_ids - new_ids), list(new_ids - old_ids)
+        if removed:
+            changes.append('del as (delete from imports_citizen_relatives '
+                           'where from_citizen_id = %s and to_citizen_id = any(%s::int[]) '
+                           'or to_citizen_id = %s and from_citizen_id = any(%s::int[]))')
+            params += [pk, removed, pk, removed]
+        if added:
+            # union схлопывает связь жителя с самим собой в одну строку, как и у джанги
+            changes.append('ins as (insert into imports_citizen_relatives (from_citizen_id, to_citizen_id) '
+                           'select %s, unnest(%s::int[]) union select unnest(%s::int[]), %s)')
+            params += [pk, added, added, pk]
+        relatives = found_relatives
+
+    old_month, new_month = old_citizen.birth_date.month, citizen.birth_date.month
+    if birthdays_ready and (new_relatives is not None or new_month != old_month):
+        deltas = birthday_deltas(citizen_id, old_month, new_month,
+                                 {rel[1]: rel[2] for rel in old_relatives},
+                                 None if new_relatives is None else {rel[1]: rel[2] for rel in found_relatives})
+        if deltas:
+            sql, upsert_params = birthday_upsert(import_id, deltas)
+            changes.append('bd as ({})'.format(sql))
+            params += upsert_params
+    if towns_ready and (citizen.town, citizen.birth_date) != (old_citizen.town, old_citizen.birth_date):
+        sql, upsert_params = town_upsert(import_id, {(old_citizen.town, old_citizen.birth_date): -1,
+                                                     (citizen.town, citizen.birth_date): 1})
+        changes.append('tw as ({})'.format(sql))
+        params += upsert_params
+
+    if changes:
+        cur.execute('with ' + ', '.join(changes) + ' select 1', params)
+    return CitizenDTO(citizen, [rel[1] for rel in relatives])
+
+
+# Чтение для пакетного PATCH: поднимает версию импорта и блокирует всех упомянутых жителей,
+# у каждого - старые родственники в виде [citizen_id, месяц, id]
+change_citizens_read_sql = \
+    'with imp as (update imports_import set version = version + 1 where import_id = %s ' \
+    'returning birthdays_ready, towns_ready) ' \
+    'select imp.birthdays_ready, imp.towns_ready, c.* from imp left join (' \
+    'select c.citizen_id, c.id, c.town, c.street, c.building, c.appartement, c.name, c.birth_date, c.gender, ' \
+    'array(select array[r.citizen_id, extract(month from r.birth_date)::int, r.id] ' \
+    'from imports_citizen_relatives cr, imports_citizen r where cr.from_citizen_id = c.id and r.id = cr.to_citizen_id) ' \
+    'from imports_citizen c where c.import_id = %s and c.citizen_id = any(%s::int[]) for update) c on true'
+
+
+def edge(a, b):
+    return (a, b) if a <= b else (b, a)
 
 
 @transaction.atomic
-def handle_get_import(import_id):
+def handle_change_citizens(import_id, changes):
+    """
+    Пакетный PATCH: changes - [(citizen_id, CitizenRecord с новыми полями, новые родственники или None)],
+    уже проверенные validate_changes. Все изменения применяются одной CTE на массивах
+    """
+    citizen_ids = {citizen_id for citizen_id, _, _ in changes}
+    for _, _, relatives in changes:
+        if relatives is not None:
+            citizen_ids.update(relatives)
+    # Весь пакет проверяем по карте жителей до блокировок, за загрузку карты платим один раз на воркер
+    citizen_map = import_registry.citizen_map(import_id)
+    if citizen_map is not None:
+        changed_ids = [citizen_id for citizen_id, _, _ in changes]
+        if citizen_map.resolve(changed_ids) is None:
+            raise CitizenNotFound(next(citizen_id for citizen_id in changed_ids
+                                       if citizen_map.resolve([citizen_id]) is None))
+        if citizen_map.resolve(list(citizen_ids)) is None:
+            raise RelativesNotFound()
+    cur = connection.cursor()
+    cur.execute(change_citizens_read_sql, [import_id, import_id, int32_only(citizen_ids)])
+    rows = cur.fetchall()
+    if not rows:
+        raise ImportNotFound(import_id)
+    birthdays_ready, towns_ready = rows[0][:2]
+    loaded = {row[2]: row[3:] for row in rows if row[2] is not None}
+    for citizen_id, _, _ in changes:
+        if citizen_id not in loaded:
+            raise CitizenNotFound(citizen_id)
+    if len(loaded) != len(citizen_ids):
+        raise RelativesNotFound()
+    if cache.cache_enabled():
+        transaction.on_commit(lambda: cache.invalidate(import_id))
+
+    pks = {citizen_id: row[0] for citizen_id, row in loaded.items()}
+    old_months = {citizen_id: row[6].month for citizen_id, row in loaded.items()}
+    old_relatives = {}
+    for citizen_id, _, _ in changes:
+        old_relatives[citizen_id] = relatives = {}
+        for rel_id, month, pk in loaded[citizen_id][8]:
+            relatives[rel_id] = old_months[rel_id] = month
+            pks[rel_id] = pk
+    new_months = dict(old_months)
+
+    old_citizens = {}
+    citizens = {}
+    updated = []
+    old_edges = set()
+    removed = set()
+    added = set()
+    for citizen_id, info, relatives in changes:
+        old_citizens[citizen_id] = old_citizen = CitizenRecord(citizen_id, *loaded[citizen_id][1:8])
+        citizens[citizen_id] = citizen = CitizenRecord(citizen_id, **{
+            field: getattr(old_citizen, field) if getattr(info, field) is None else getattr(info, field)
+            for field in citizen_update_fields})
+        if any(getattr(info, field) is not None for field in citizen_update_fields):
+            updated.append(citizen)
+        new_months[citizen_id] = citizen.birth_date.month
+        if relatives is not None or new_months[citizen_id] != old_months[citizen_id]:
+            old_edges.update(edge(citizen_id, rel_id) for rel_id in old_relatives[citizen_id])
+        if relatives is not None:
+            removed.update(edge(citizen_id, rel_id) for rel_id in old_relatives[citizen_id] if rel_id not in relatives)
+            added.update(edge(citizen_id, rel_id) for rel_id in relatives if rel_id not in old_relatives[citizen_id])
+
+    statements = []
+    params = []
+    if updated:
+        statements.append('upd as (update imports_citizen c set town = v.town, street = v.street, '
+                          'building = v.building, appartement = v.appartement, name = v.name, '
+                          'birth_date = v.birth_date, gender = v.gender from (select unnest(%s::int[]) id, '
+                          'unnest(%s::varchar[]) town, unnest(%s::varchar[]) street, unnest(%s::varchar[]) building, '
+                          'unnest(%s::int[]) appartement, unnest(%s::varchar[]) name, unnest(%s::date[]) birth_date, '
+                          'unnest(%s::varchar[]) gender) v where c.id = v.id)')
+        params += [[pks[citizen.citizen_id] for citizen in updated]] + \
+            [[getattr(citizen, field) for citizen in updated] for field in citizen_update_fields]
+    if removed:
+        from_ids, to_ids = [pks[a] for a, _ in removed], [pks[b] for _, b in removed]
+        statements.append('del as (delete from imports_citizen_relatives cr '
+                          'using (select unnest(%s::int[]) a, unnest(%s::int[]) b) e '
+                          'where cr.from_citizen_id = e.a and cr.to_citizen_id = e.b '
+                          'or cr.from_citizen_id = e.b and cr.to_citizen_id = e.a)')
+        params += [from_ids, to_ids]
+    if added:
+        from_ids, to_ids = [pks[a] for a, _ in added], [pks[b] for _, b in added]
+        statements.append('ins as (insert into imports_citizen_relatives (from_citizen_id, to_citizen_id) '
+                          'select unnest(%s::int[]), unnest(%s::int[]) union select unnest(%s::int[]), unnest(%s::int[]))')
+        params += [from_ids, to_ids, to_ids, from_ids]
+    if birthdays_ready:
+        deltas = edges_birthday_deltas(old_edges, (old_edges - removed) | added, old_months, new_months)
+        if deltas:
+            sql, upsert_params = birthday_upsert(import_id, deltas)
+            statements.append('bd as ({})'.format(sql))
+            params += upsert_params
+    if towns_ready:
+        deltas = count_town_birth_dates(citizens.values())
+        deltas.subtract(count_town_birth_dates(old_citizens.values()))
+        deltas = {key: delta for key, delta in deltas.items() if delta}
+        if deltas:
+            sql, upsert_params = town_upsert(import_id, deltas)
+            statements.append('tw as ({})'.format(sql))
+            params += upsert_params
+    if statements:
+        cur.execute('with ' + ', '.join(statements) + ' select 1', params)
+
+    # Итоговые родственники: новые списки из запроса, у остальных - старые с поправкой на связи из пакета
+    final_relatives = {citizen_id: relatives for citizen_id, _, relatives in changes if relatives is not None}
+    kept_relatives = {citizen_id: list(old_relatives[citizen_id])
+                      for citizen_id, _, relatives in changes if relatives is None}
+    for edges, update in ((removed, list.remove), (added, list.append)):
+        for a, b in edges:
+            if a in kept_relatives:
+                update(kept_relatives[a], b)
+            if b in kept_relatives and a != b:
+                update(kept_relatives[b], a)
+    final_relatives.update(kept_relatives)
+    return [CitizenDTO(citizens[citizen_id], final_relatives[citizen_id]) for citizen_id, _, _ in changes]
+
+
+def handle_get_version(import_id):
+    version = Import.objects.filter(import_id=import_id).values_list('version', flat=True).first()
+    if version is not None:
+        import_registry.add(import_id)
+    return version
+
+
+def check_import(import_id):
+    # Импорты не удаляются, поэтому однажды найденный импорт больше не проверяем
+    if import_registry.exists(import_id):
+        return
     if not Import.objects.filter(import_id=import_id).exists():
         raise ImportNotFound(import_id)
+    import_registry.add(import_id)
+
+
+@transaction.atomic
+def handle_get_import(import_id):
+    check_import(import_id)
     citizens = Citizen.objects.filter(import_id_id=import_id).all()
     sql = 'select from_citizen_id, citizen_id to_id ' \
           'from imports_citizen_relatives, imports_citizen cit ' \
@@ -89,42 +347,188 @@ def handle_get_import(import_id):
     return [CitizenDTO(citizen, relative_map[citizen.id]) for citizen in citizens]
 
 
+relatives_from_sql = 'from imports_citizen_relatives cr, imports_citizen r ' \
+                     'where r.id = cr.to_citizen_id and cr.from_citizen_id = c.id'
+
+citizen_columns = {
+    'citizen_id': 'c.citizen_id',
+    'town': 'c.town',
+    'street': 'c.street',
+    'building': 'c.building',
+    'appartement': 'c.appartement',
+    'name': 'c.name',
+    'birth_date': 'c.birth_date',
+    'gender': 'c.gender',
+    'relatives': 'array(select r.citizen_id {})'.format(relatives_from_sql),
+}
+
+# Те же поля, но уже в виде JSON. to_json экранирует строки так же,
+# как json.dumps(..., ensure_ascii=False), поэтому ответ совпадает побайтно
+citizen_json_columns = {
+    'citizen_id': 'c.citizen_id',
+    'town': 'to_json(c.town)',
+    'street': 'to_json(c.street)',
+    'building': 'to_json(c.building)',
+    'appartement': 'c.appartement',
+    'name': 'to_json(c.name)',
+    # FM убирает ведущие нули года: strftime('%Y') пишет 999-й год как "999", а не "0999"
+    'birth_date': "to_json(to_char(c.birth_date, 'DD.MM.FMYYYY'))",
+    'gender': 'to_json(c.gender)',
+    'relatives': "'[' || coalesce((select string_agg(r.citizen_id::text, ', ') {}), '') || ']'".format(relatives_from_sql),
+}
+
+
+def citizens_projection_sql(fields):
+    """
+    Выборка только запрошенных полей жителя. Первой колонкой всегда идет citizen_id - по нему строится курсор страниц
+    """
+    return 'select c.citizen_id, {} from imports_citizen c where c.import_id = %s'.format(
+        ', '.join(citizen_columns[field] for field in fields))
+
+
+def citizens_projection_json_sql(fields):
+    """
+    То же, что citizens_projection_sql, но JSON жителя собирает сам Postgres
+    """
+    template = '{' + ', '.join('"{}": %%s'.format(field) for field in fields) + '}'
+    return "select c.citizen_id, convert_to(format('{}', {}), 'UTF8') from imports_citizen c where c.import_id = %s".format(
+        template, ', '.join(citizen_json_columns[field] for field in fields))
+
+
+citizens_sql = 'select {} from imports_citizen c where c.import_id = %s'.format(
+    ', '.join(citizen_columns[field] for field in CITIZEN_FIELDS))
+citizens_json_sql = citizens_projection_json_sql(CITIZEN_FIELDS)
+
+
+def handle_stream_import(import_id, sql=citizens_sql):
+    check_import(import_id)
+    return iter_import_rows(import_id, sql)
+
+
+def handle_get_import_page(import_id, after_citizen_id, limit, sql=citizens_sql):
+    """
+    Страница жителей по ключу (import_id, citizen_id): идем по уникальному индексу
+    от after_citizen_id и берем на одного больше, чтобы понять, есть ли следующая страница
+    """
+    check_import(import_id)
+    with connection.cursor() as cur:
+        cur.execute(sql + ' and c.citizen_id > %s order by c.citizen_id limit %s',
+                    [import_id, -1 if after_citizen_id is None else after_citizen_id, limit + 1])
+        rows = cur.fetchall()
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1][0]
+    return rows, None
+
+
+def iter_import_rows(import_id, sql, chunk_size=2000):
+    # Именованный (серверный) курсор открываем в своей транзакции внутри генератора: тогда он WITHOUT HOLD
+    # и строки выбираются по мере отдачи ответа клиенту. Вне транзакции джанга открыла бы его WITH HOLD,
+    # и Postgres выполнил бы весь запрос и сохранил результат целиком еще на DECLARE
+    with transaction.atomic(), connection.chunked_cursor() as cur:
+        cur.execute(sql, [import_id])
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+
 @transaction.atomic
 def handle_birth_days(import_id):
-    if not Import.objects.filter(import_id=import_id).exists():
+    birthdays_ready = Import.objects.filter(import_id=import_id).values_list('birthdays_ready', flat=True).first()
+    if birthdays_ready is None:
         raise ImportNotFound(import_id=import_id)
-    citizens = Citizen.objects.filter(import_id_id=import_id).all()
-    sql = 'select from_citizen_id, birth_date to_id ' \
-          'from imports_citizen_relatives, imports_citizen cit ' \
-          'WHERE cit.id = to_citizen_id and import_id=%s'
     cur = connection.cursor()
-    cur.execute(sql, [import_id])
+    if settings.IMPORTS_BIRTHDAYS_ENGINE == 'sql':
+        cur.execute(birthdays_sql + ' order by 2, 1', [import_id])
+    else:
+        if not birthdays_ready:
+            # Импорт загружен до появления агрегата - строим его один раз под блокировкой строки импорта
+            imports = Import.objects.select_for_update().filter(import_id=import_id)
+            if not imports.values_list('birthdays_ready', flat=True).first():
+                build_birthdays(cur, import_id)
+                imports.update(birthdays_ready=True)
+        cur.execute('select citizen_id, month, presents from imports_birthdaypresents '
+                    'where import_id = %s and presents > 0 order by month, citizen_id', [import_id])
     result = {str(month): [] for month in range(1, 13)}
-    relative_birth_date_map = {citizen.id: [] for citizen in citizens}
-    for from_id, to_birth_date in cur.fetchall():
-        relative_birth_date_map[from_id].append(to_birth_date)
-
-    for citizen in citizens:
-        buf_res = [0] * 12
-        for relative_birth_date in relative_birth_date_map[citizen.id]:
-            buf_res[relative_birth_date.month - 1] += 1
-        for i in range(len(buf_res)):
-            if buf_res[i] != 0:
-                result[str(i + 1)].append({"citizen_id": citizen.citizen_id, "presents": buf_res[i]})
+    for citizen_id, month, presents in cur.fetchall():
+        result[str(month)].append({"citizen_id": citizen_id, "presents": presents})
     return result
 
 
 @transaction.atomic
 def handle_percentile(import_id):
-    if not Import.objects.filter(import_id=import_id).exists():
+    row = Import.objects.filter(import_id=import_id).values_list('version', 'towns_ready').first()
+    if row is None:
         raise ImportNotFound(import_id=import_id)
+    version, towns_ready = row
+    # Возрасты меняются только со сменой UTC-даты, поэтому результат кешируем на (импорт, версия, дата)
+    today = datetime.utcnow().date()
+    engine = settings.IMPORTS_PERCENTILE_ENGINE
+    if engine == 'python':
+        compute = lambda: percentile_python(import_id, today)
+    elif engine == 'numpy':
+        compute = lambda: percentile_numpy(import_id, today)
+    else:
+        compute = lambda: percentile_histogram(import_id, towns_ready, today)
+    return percentile_cache.get_or_compute((import_id, version, engine), today, compute)
+
+
+def percentile_histogram(import_id, towns_ready, today):
+    cur = connection.cursor()
+    if not towns_ready:
+        # Импорт загружен до появления гистограммы - строим ее один раз под блокировкой строки импорта
+        imports = Import.objects.select_for_update().filter(import_id=import_id)
+        if not imports.values_list('towns_ready', flat=True).first():
+            build_town_birth_dates(cur, import_id)
+            imports.update(towns_ready=True)
+    # Чем позже дата рождения, тем меньше возраст, поэтому возрасты каждого города идут по возрастанию
+    cur.execute('select town, birth_date, citizens from imports_townbirthdates '
+                'where import_id = %s and citizens > 0 order by town, birth_date desc', [import_id])
+    town_map = {}
+    for town, birth_date, citizens in cur.fetchall():
+        ages, counts = town_map.setdefault(town, ([], []))
+        ages.append(calculate_age(birth_date, today))
+        counts.append(citizens)
+    result = []
+    for town, (ages, counts) in town_map.items():
+        p50, p75, p99 = percentiles_from_counts(ages, counts, [50, 75, 99])
+        result.append({"town": town, "p50": round(p50, 2), "p75": round(p75, 2), "p99": round(p99, 2)})
+    return result
+
+
+def percentile_numpy(import_id, today):
+    """
+    Перцентили по колонкам (город, дата рождения) без обхода жителей в питоне: возрасты считаются
+    векторно, а все города разбираются за одну сортировку
+    """
+    cur = connection.cursor()
+    cur.execute("select town, birth_date - date '1970-01-01' from imports_citizen where import_id = %s", [import_id])
+    rows = cur.fetchall()
+    if not rows:
+        return []
+    towns, days = zip(*rows)
+    town_names, town_codes = numpy.unique(numpy.array(towns, dtype=object), return_inverse=True)
+    ages = calculate_ages(numpy.array(days, dtype='datetime64[D]'), today)
+
+    order = numpy.lexsort((ages, town_codes))
+    town_codes, ages = town_codes[order], ages[order]
+    bounds = numpy.flatnonzero(numpy.diff(town_codes)) + 1
+    result = []
+    for code, town_ages in zip(town_codes[numpy.concatenate(([0], bounds))], numpy.split(ages, bounds)):
+        p50, p75, p99 = numpy.percentile(town_ages, [50, 75, 99])
+        result.append({"town": town_names[code], "p50": round(p50, 2), "p75": round(p75, 2), "p99": round(p99, 2)})
+    return result
+
+
+def percentile_python(import_id, today):
     citizens = Citizen.objects.filter(import_id_id=import_id).all()
     town_map = {}
     for citizen in citizens:
         if citizen.town in town_map.keys():
-            town_map[citizen.town].append(calculate_age(citizen.birth_date))
+            town_map[citizen.town].append(calculate_age(citizen.birth_date, today))
         else:
-            town_map.update({citizen.town: [calculate_age(citizen.birth_date)]})
+            town_map.update({citizen.town: [calculate_age(citizen.birth_date, today)]})
     return [{"town": town,
              "p50": round(numpy.percentile(ages, 50), 2),
              "p75": round(numpy.percentile(ages, 75), 2),
@@ -132,11 +536,22 @@ def handle_percentile(import_id):
              } for town, ages in town_map.items()]
 
 
-def calculate_age(birthdate):
-    today = datetime.utcnow().date()
+def calculate_age(birthdate, today=None):
+    today = today or datetime.utcnow().date()
     return today.year - birthdate.year - ((today.month, today.day) < (birthdate.month, birthdate.day))
 
 
+def calculate_ages(birth_dates, today):
+    """
+    calculate_age для массива datetime64[D]
+    """
+    years = birth_dates.astype('datetime64[Y]').astype(numpy.int64) + 1970
+    month_starts = birth_dates.astype('datetime64[M]')
+    months = month_starts.astype(numpy.int64) % 12 + 1
+    days = (birth_dates - month_starts).astype(numpy.int64) + 1
+    return today.year - years - (today.month * 100 + today.day < months * 100 + days)
+
+
 # Собственная реализация функции расчета перцентиля,
 # которая работает в 2 раза медленнее numpy.percentile (неожиданно),
 # но работает корректно на массиве из целых чисел (а вот это реально неожиданно)
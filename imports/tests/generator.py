@@ -1,6 +1,7 @@
 import datetime
+import json
 
-from imports.dto import CitizenDTO
+from imports.dto import CitizenDTO, CitizenDTOEncoder
 import random
 
 from imports.models import Citizen
@@ -836,3 +837,15 @@ def generate_citizens_in_db(import_obj, count=1, to_return='gen'):
     elif to_return == 'db':
         return db_citizens
     return gen_citizens, db_citizens
+
+
+def create_import(client, citizens):
+    # POST /imports через тестовый клиент, возвращает import_id
+    data = json.dumps({'citizens': citizens}, cls=CitizenDTOEncoder, ensure_ascii=False).encode('utf8')
+    response = client.generic('POST', '/imports', data, content_type='application/json')
+    return json.loads(response.content)['data']['import_id']
+
+
+def count_queries(queries):
+    # Запросы из CaptureQueriesContext без SAVEPOINT-ов, которыми тестовые транзакции обрамляют atomic
+    return len([query for query in queries if 'SAVEPOINT' not in query['sql']])
@@ -0,0 +1,24 @@
+import shutil
+import tempfile
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class ImportsTestRunner(DiscoverRunner):
+    """
+    Тесты не трогают общий кеш ответов хоста: каталог кеша - временный, а сам кеш по умолчанию
+    выключен, чтобы сравнения движков не получали из кеша свой же ответ. Тесты кеша включают его явно
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.cache_dir = tempfile.mkdtemp(prefix='yandex-imports-cache-')
+        self.cache_settings = override_settings(IMPORTS_RESPONSE_CACHE_DIR=self.cache_dir,
+                                                IMPORTS_RESPONSE_CACHE_SIZE=0)
+        self.cache_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.cache_settings.disable()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
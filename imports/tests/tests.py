@@ -1,9 +1,29 @@
-from django.test import TestCase
-from imports.models import Import, Citizen
-
-from imports.dto import CitizenDTOEncoder
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from imports import cache
+from imports.models import Import, Citizen, ImportJob
+
+from django.core.exceptions import ValidationError
+
+from imports.dto import CitizenDTOEncoder, DataResponse
+from imports.exceptions import BadRelativesGiven, NotSymmetricalRelatives
+from imports.parsers import iter_citizens, iter_ndjson_citizens
+from imports.serializers import dump_citizen_response, dump_citizens_response, iter_citizens_response
+from imports.registry import CitizenMap, ImportRegistry
+from imports.service import calculate_age, calculate_ages, handle_percentile, import_registry
 from imports.tests.generator import *
+from imports.validators import validate, CitizenValidator, check_relatives, check_relatives_sets
+import gzip
+import io
+import shutil
+import tempfile
 import json
+from json import JSONDecodeError
+import random
+import zlib
+import time
 import numpy
 
 
@@ -185,6 +205,334 @@ class TestImports(TestCase):
         print("Add - {}".format((e-s).total_seconds()))
 
 
+class TestImportLoaders(TestCase):
+    url = '/imports'
+
+    def test_special_characters(self):
+        citizens = generate_citizens(3, provide_relatives=False)
+        citizens[0].town = 'Tab\tand\\backslash\\N'
+        citizens[1].street = 'New\nline\r and \\.'
+        citizens[2].name = 'Ёжиков \\N Ёж'
+        citizens[0].relatives = [1, 2]
+        citizens[1].relatives = [1]
+        for loader in ['insert', 'copy_text', 'copy_binary']:
+            with self.settings(IMPORTS_LOADER=loader):
+                data = json.dumps({'citizens': citizens}, cls=CitizenDTOEncoder, ensure_ascii=False).encode('utf8')
+                response = self.client.generic('POST', self.url, data, content_type='application/json')
+                self.assertEqual(response.status_code, 201)
+                import_id = json.loads(response.content)['data']['import_id']
+                for db_cit in Citizen.objects.filter(import_id=import_id):
+                    citizen = citizens[db_cit.citizen_id - 1]
+                    self.assertEqual((db_cit.town, db_cit.street, db_cit.name, db_cit.birth_date.strftime('%d.%m.%Y')),
+                                     (citizen.town, citizen.street, citizen.name, citizen.birth_date))
+                    self.assertEqual({rel.citizen_id for rel in db_cit.relatives.all()}, set(citizen.relatives))
+
+    def test_loaders_benchmark(self):
+        citizens = generate_citizens(10000)
+        data = json.dumps({'citizens': citizens}, cls=CitizenDTOEncoder, ensure_ascii=False).encode('utf8')
+        for loader in ['insert', 'copy_text', 'copy_binary']:
+            with self.settings(IMPORTS_LOADER=loader):
+                s = datetime.datetime.now()
+                response = self.client.generic('POST', self.url, data, content_type='application/json')
+                e = datetime.datetime.now()
+            self.assertEqual(response.status_code, 201)
+            import_id = json.loads(response.content)['data']['import_id']
+            db_ids = list(Citizen.objects.filter(import_id=import_id).values_list('id', flat=True))
+            self.assertEqual(len(db_ids), 10000)
+            self.assertEqual(Citizen.relatives.through.objects.filter(from_citizen_id__in=db_ids).count(),
+                             sum(len(citizen.relatives) for citizen in citizens))
+            print("Add ({}) - {}".format(loader, (e - s).total_seconds()))
+
+
+class TestAsyncImports(TransactionTestCase):
+    url = '/imports'
+
+    def test_async_import(self):
+        citizens = generate_citizens(100)
+        data = json.dumps({'citizens': citizens}, cls=CitizenDTOEncoder, ensure_ascii=False).encode('utf8')
+        response = self.client.generic('POST', self.url, data, content_type='application/json',
+                                       HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, 202)
+        job_id = json.loads(response.content)['data']['job_id']
+        self.assertEqual(response['Location'], '/imports/jobs/{}'.format(job_id))
+
+        for i in range(100):
+            job = json.loads(self.client.get(response['Location']).content)['data']
+            if job['status'] in ['done', 'failed']:
+                break
+            time.sleep(0.1)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(Citizen.objects.filter(import_id=job['import_id']).count(), 100)
+
+        citizens[0].relatives = [100000]
+        data = json.dumps({'citizens': citizens}, cls=CitizenDTOEncoder, ensure_ascii=False).encode('utf8')
+        response = self.client.generic('POST', self.url, data, content_type='application/json',
+                                       HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_job(self):
+        response = self.client.get('/imports/jobs/1000000')
+        self.assertEqual(response.status_code, 404)
+
+    def test_lost_job(self):
+        job = ImportJob.objects.create(status=ImportJob.RUNNING)
+        self.assertEqual(json.loads(self.client.get('/imports/jobs/{}'.format(job.job_id)).content)['data']['status'],
+                         'running')
+        ImportJob.objects.filter(job_id=job.job_id).update(
+            started_at=job.started_at - datetime.timedelta(seconds=settings.IMPORTS_ASYNC_JOB_TIMEOUT + 1))
+        response = self.client.get('/imports/jobs/{}'.format(job.job_id))
+        self.assertEqual(json.loads(response.content)['data']['status'], 'failed')
+        self.assertEqual(ImportJob.objects.filter(job_id=job.job_id).values_list('status', flat=True).get(),
+                         ImportJob.FAILED)
+
+
+class TestNdjsonImports(TestCase):
+    url = '/imports/ndjson'
+
+    def test_parse(self):
+        citizens = generate_citizens(20)
+        lines = [json.dumps(citizen, cls=CitizenDTOEncoder, ensure_ascii=False) for citizen in citizens]
+        data = ('\n\n'.join(lines) + '\n').encode('utf8')
+        for chunk_size in [1, 5, 64, 1024 * 1024]:
+            self.assertEqual(list(iter_ndjson_citizens(io.BytesIO(data), chunk_size)), [json.loads(line) for line in lines])
+
+    def test_import(self):
+        citizens = generate_citizens(100)
+        data = '\n'.join(json.dumps(citizen, cls=CitizenDTOEncoder, ensure_ascii=False) for citizen in citizens)
+        response = self.client.generic('POST', self.url, data.encode('utf8'), content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 201)
+        import_id = json.loads(response.content)['data']['import_id']
+        self.assertEqual(Citizen.objects.filter(import_id=import_id).count(), 100)
+
+        for data in [b'', b'\n \n', b'{"citizen_id": 1}\n{', b'[]', b'1']:
+            response = self.client.generic('POST', self.url, data, content_type='application/x-ndjson')
+            self.assertEqual(response.status_code, 400)
+
+
+class TestCompressedBodies(TestCase):
+    url = '/imports'
+
+    def compress(self, data, encoding):
+        if encoding == 'gzip':
+            return gzip.compress(data)
+        if encoding == 'deflate':
+            return zlib.compress(data)
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def test_import(self):
+        citizens = generate_citizens(100)
+        data = json.dumps({'citizens': citizens}, cls=CitizenDTOEncoder, ensure_ascii=False).encode('utf8')
+        for encoding in ['gzip', 'deflate', 'raw deflate']:
+            body = self.compress(data, encoding)
+            response = self.client.generic('POST', self.url, body, content_type='application/json',
+                                           HTTP_CONTENT_ENCODING=encoding.split()[-1])
+            self.assertEqual(response.status_code, 201)
+            import_id = json.loads(response.content)['data']['import_id']
+            self.assertEqual(Citizen.objects.filter(import_id=import_id).count(), 100)
+
+            response = self.client.generic('POST', self.url, body[:len(body) // 2], content_type='application/json',
+                                           HTTP_CONTENT_ENCODING=encoding.split()[-1])
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client.generic('POST', self.url, data, content_type='application/json',
+                                       HTTP_CONTENT_ENCODING='br')
+        self.assertEqual(response.status_code, 415)
+
+        with self.settings(IMPORTS_MAX_DECOMPRESSED_SIZE=len(data) - 1):
+            response = self.client.generic('POST', self.url, gzip.compress(data), content_type='application/json',
+                                           HTTP_CONTENT_ENCODING='gzip')
+            self.assertEqual(response.status_code, 400)
+
+    def test_patch(self):
+        import_obj = Import()
+        Import.save(import_obj)
+        generate_citizens_in_db(import_obj, 1)
+        data = json.dumps({"name": "Новое имя"}).encode('utf8')
+        response = self.client.generic('PATCH', '/imports/{}/citizens/1'.format(import_obj.import_id), gzip.compress(data),
+                                       content_type='application/json', HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf8'))['data']['name'], "Новое имя")
+
+
+class TestIdempotentImports(TestCase):
+    url = '/imports'
+
+    def post(self, data, **extra):
+        response = self.client.generic('POST', self.url, data, content_type='application/json', **extra)
+        self.assertEqual(response.status_code, 201)
+        return json.loads(response.content)['data']['import_id']
+
+    def test_idempotency_key(self):
+        data = json.dumps({'citizens': generate_citizens(10)}, cls=CitizenDTOEncoder, ensure_ascii=False).encode('utf8')
+        import_id = self.post(data, HTTP_IDEMPOTENCY_KEY='first')
+        self.assertEqual(self.post(data, HTTP_IDEMPOTENCY_KEY='first'), import_id)
+        response = self.client.generic('POST', self.url, b'not even json', content_type='application/json',
+                                       HTTP_IDEMPOTENCY_KEY='first')
+        self.assertEqual(response.status_code, 422)
+        gzipped = self.client.generic('POST', self.url, gzip.compress(data), content_type='application/json',
+                                      HTTP_IDEMPOTENCY_KEY='first', HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(json.loads(gzipped.content)['data']['import_id'], import_id)
+        self.assertNotEqual(self.post(data, HTTP_IDEMPOTENCY_KEY='second'), import_id)
+        self.assertNotEqual(self.post(data), import_id)
+        self.assertEqual(Citizen.objects.filter(import_id=import_id).count(), 10)
+
+        response = self.client.generic('POST', self.url, data, content_type='application/json',
+                                       HTTP_IDEMPOTENCY_KEY='k' * 257)
+        self.assertEqual(response.status_code, 400)
+
+    def test_digest(self):
+        data = json.dumps({'citizens': generate_citizens(10)}, cls=CitizenDTOEncoder, ensure_ascii=False).encode('utf8')
+        with self.settings(IMPORTS_DEDUPLICATE_BY_DIGEST=True):
+            import_id = self.post(data)
+            self.assertEqual(self.post(data), import_id)
+            self.assertNotEqual(self.post(data + b' '), import_id)
+        self.assertNotEqual(self.post(data), import_id)
+
+
+class TestCitizensStreamParser(TestCase):
+
+    def parse(self, data, chunk_size=7):
+        return list(iter_citizens(io.BytesIO(data.encode('utf8')), chunk_size=chunk_size))
+
+    def test_chunk_boundaries(self):
+        citizens = generate_citizens(50)
+        data = json.dumps({'other': {'citizens': [1]}, 'citizens': citizens, 'tail': [123456789]},
+                          cls=CitizenDTOEncoder, ensure_ascii=False)
+        expected = json.loads(data)['citizens']
+        for chunk_size in [1, 2, 3, 7, 64, 1024 * 1024]:
+            self.assertEqual(self.parse(data, chunk_size), expected)
+
+    def test_bad_data(self):
+        for data in ['[]', '{}', '{"citizens": null}', '{"citizens": []}', '{"citizens": {}}',
+                     '{"citizens": [{"citizen_id": 1}], "citizens": [{}]}']:
+            with self.assertRaises(ValidationError):
+                self.parse(data)
+        for data in ['{"citizens": [{"citizen_id": 1} {}]}', '{"citizens": [{}]} extra', '{citizens: [{}]}',
+                     '{"citizens": [{}]', '{"citizens": [{}],}']:
+            with self.assertRaises(ValueError):
+                self.parse(data)
+
+    def test_fail_fast(self):
+        body = io.BytesIO(b'{"citizens": [{"citizen_id": "bad"}, ' + b'{"citizen_id": 2}, ' * 100000 + b'{}]}')
+        response = self.client.generic('POST', '/imports', body.getvalue(), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        stream = io.BytesIO(body.getvalue())
+        with self.assertRaises(ValidationError):
+            validate(iter_citizens(stream, chunk_size=1024))
+        self.assertLess(stream.tell(), 4096)
+
+    def test_fail_fast_on_malformed_json(self):
+        body = b'{"citizens": [{"citizen_id": 1, "town": x}, ' + b'{"citizen_id": 2}, ' * 100000 + b'{}]}'
+        stream = io.BytesIO(body)
+        with self.assertRaises(JSONDecodeError):
+            list(iter_citizens(stream, chunk_size=1024))
+        self.assertLess(stream.tell(), 4096)
+        # Значения, оборванные границей чанка, по-прежнему дочитываются
+        for chunk_size in (1, 2, 3, 7):
+            data = '{"citizens": [{"name": "Имя \\u0418", "flag": true, "none": null, "n": -12.5e3}]}'
+            self.assertEqual(list(iter_citizens(io.BytesIO(data.encode('utf8')), chunk_size=chunk_size)),
+                             json.loads(data)['citizens'])
+
+
+class TestCitizenValidator(TestCase):
+
+    def test_messages(self):
+        validator = CitizenValidator(today=datetime.date(2019, 8, 20))
+        cases = [
+            ({'town': 'Москва'}, True, "citizen_id not specified"),
+            ({'citizen_id': 1}, False, "citizen_id must not be specified"),
+            ({'name': None}, False, "name not specified"),
+            ({'appartement': '1'}, False, "appartement must be integer"),
+            ({'appartement': -1}, False, "appartement must be not negative integer"),
+            ({'street': ' '}, False, "street must be string with length in (0, 256]"),
+            ({'birth_date': '01-01-2019'}, False, "birth_date invalid format. Must be '%d.%m.%Y'"),
+            ({'birth_date': '20.08.2019'}, False, "Future 'birth_date' date given"),
+            ({'gender': 'fmale'}, False, "Invalid gender - fmale. Must be only 'male' or 'female'"),
+            ({'relatives': [1, 1]}, False, "duplicate relatives ids given"),
+            ({}, False, "No one field is provided. Must be at least one"),
+            ({'name': 'Имя', 'redundant': 1}, False, "there are 1 redundant fields"),
+        ]
+        for citizen, full, message in cases:
+            with self.assertRaises(ValidationError) as context:
+                validator.validate_citizen(citizen, full=full)
+            self.assertEqual(context.exception.message, message)
+
+        citizen, relatives = validator.validate_citizen({'birth_date': '19.08.2019', 'relatives': []}, full=False)
+        self.assertEqual(citizen.birth_date, datetime.date(2019, 8, 19))
+        self.assertEqual(relatives, [])
+
+        first, _ = validator.validate_citizen({'town': ''.join(['Моск', 'ва'])}, full=False)
+        second, _ = validator.validate_citizen({'town': ''.join(['Мо', 'сква'])}, full=False)
+        self.assertIs(first.town, second.town)
+
+
+    def test_relatives_check(self):
+        def first_error(check, relative_map):
+            try:
+                check(relative_map)
+            except ValidationError as e:
+                return type(e), e.message
+            return None
+
+        for i in range(50):
+            citizens = generate_citizens(random.randint(1, 60))
+            relative_map = {citizen.citizen_id: citizen.relatives for citizen in citizens}
+            self.assertIsNone(first_error(check_relatives, relative_map))
+            citizen = random.choice(citizens)
+            if i % 3 == 0:
+                citizen.relatives.append(random.choice([1000, -5, 2 ** 40]))
+            elif set(citizen.relatives) - {citizen.citizen_id}:
+                citizen.relatives.remove(max(set(citizen.relatives) - {citizen.citizen_id}))
+            else:
+                continue
+            self.assertIsNotNone(first_error(check_relatives, relative_map))
+            self.assertEqual(first_error(check_relatives, relative_map), first_error(check_relatives_sets, relative_map))
+        self.assertEqual(first_error(check_relatives, {1: [2 ** 70]}), first_error(check_relatives_sets, {1: [2 ** 70]}))
+        self.assertEqual(first_error(check_relatives, {1: [2], 2: [0]}),
+                         (NotSymmetricalRelatives, NotSymmetricalRelatives(1, 2).message))
+
+        # Несколько ошибок в одной карте, в том числе несуществующие родственники
+        rnd = random.Random(0)
+        for _ in range(2000):
+            ids = rnd.sample(range(10), rnd.randint(1, 6))
+            relative_map = {citizen_id: rnd.sample(range(10), rnd.randint(0, 3)) for citizen_id in ids}
+            self.assertEqual(first_error(check_relatives, relative_map), first_error(check_relatives_sets, relative_map),
+                             relative_map)
+
+
+    def test_parallel_validation(self):
+        def run(data, threshold):
+            with self.settings(IMPORTS_PARALLEL_VALIDATION_THRESHOLD=threshold, IMPORTS_VALIDATION_SHARD_SIZE=7,
+                               IMPORTS_VALIDATION_PROCESSES=2):
+                try:
+                    citizens, relative_map = CitizenValidator().validate(json.loads(data))
+                except ValidationError as e:
+                    return type(e), e.message
+                return [CitizenDTO(citizen, relative_map[citizen.citizen_id]).__dict__ for citizen in citizens]
+
+        citizens = generate_citizens(100)
+        data = json.dumps(citizens, cls=CitizenDTOEncoder, ensure_ascii=False)
+        self.assertEqual(run(data, 10), run(data, None))
+        self.assertEqual(len(run(data, 10)), 100)
+
+        bad_citizens = json.loads(data)
+        bad_citizens[60]['citizen_id'] = 20
+        bad_citizens[62]['name'] = ''
+        data = json.dumps(bad_citizens, ensure_ascii=False)
+        self.assertEqual(run(data, 10), (ValidationError, "not unique citizen_id into one date batch"))
+
+        bad_citizens[60]['citizen_id'] = 61
+        data = json.dumps(bad_citizens, ensure_ascii=False)
+        self.assertEqual(run(data, 10), (ValidationError, "name must be string with length in (0, 256]"))
+
+        bad_citizens[62]['name'] = 'Имя'
+        bad_citizens[80]['relatives'].append(1000)
+        data = json.dumps(bad_citizens, ensure_ascii=False)
+        self.assertEqual(run(data, 10), run(data, None))
+        self.assertEqual(run(data, 10)[0], BadRelativesGiven)
+
+
 class TestChangeCitizen(TestCase):
     url = "/imports/{:n}/citizens/{:n}"
 
@@ -272,6 +620,15 @@ class TestChangeCitizen(TestCase):
                                      content_type='application/json')
         self.assertEqual(response.status_code, 400)
 
+    @override_settings(IMPORTS_REGISTRY_SIZE=0)
+    def test_out_of_range_ids(self):
+        import_id = create_import(self.client, generate_citizens(3, provide_relatives=False))
+        for citizen_id, relatives in ((1, [2 ** 40]), (1, [2, 2 ** 70]), (2 ** 40, [2]), (2 ** 70, None)):
+            data = {"name": "Новое имя"} if relatives is None else {"relatives": relatives}
+            response = self.client.patch(self.url.format(import_id, citizen_id), json.dumps(data),
+                                         content_type='application/json')
+            self.assertEqual(response.status_code, 404, (citizen_id, relatives))
+
     def test_change_info_citizen(self):
         import_obj = Import()
         Import.save(import_obj)
@@ -434,6 +791,34 @@ class TestChangeCitizen(TestCase):
         citizen_relatives6 = [rel.citizen_id for rel in citizen6.relatives.all()]
         self.assertEqual(set(citizen_relatives6), {4, 5})
 
+    def test_round_trips(self):
+        citizens = generate_citizens(3, provide_relatives=False)
+        import_id = create_import(self.client, citizens)
+
+        data = {"town": "Переехал", "birth_date": "01.02.1990", "relatives": [1, 2]}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(self.url.format(import_id, 1), json.dumps(data),
+                                         content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(count_queries(queries), 2)
+        response_citizen = json.loads(response.content.decode('utf8'))['data']
+        self.assertEqual(response_citizen['town'], data['town'])
+        self.assertEqual(response_citizen['birth_date'], data['birth_date'])
+        self.assertEqual(response_citizen['street'], citizens[0].street)
+        self.assertEqual(sorted(response_citizen['relatives']), [1, 2])
+        citizen = Citizen.objects.get(import_id=import_id, citizen_id=1)
+        self.assertEqual(citizen.town, data['town'])
+        self.assertEqual(sorted(rel.citizen_id for rel in citizen.relatives.all()), [1, 2])
+        self.assertEqual([rel.citizen_id for rel in Citizen.objects.get(import_id=import_id, citizen_id=2)
+                         .relatives.all()], [1])
+
+        response = self.client.patch(self.url.format(import_id, 1), json.dumps({"relatives": [3]}),
+                                     content_type='application/json')
+        self.assertEqual(json.loads(response.content.decode('utf8'))['data']['relatives'], [3])
+        self.assertEqual([rel.citizen_id for rel in Citizen.objects.get(import_id=import_id, citizen_id=3)
+                         .relatives.all()], [1])
+        self.assertEqual(Citizen.objects.get(import_id=import_id, citizen_id=2).relatives.count(), 0)
+
     def test_change_relatives_citizen_max_data(self):
         import_obj = Import()
         Import.save(import_obj)
@@ -491,9 +876,185 @@ class TestChangeCitizen(TestCase):
         print("Change - {}".format((e-s).total_seconds()))
 
 
+class TestChangeCitizens(TestCase):
+    url = "/imports/{:n}/citizens"
+
+    def patch(self, import_id, changes):
+        return self.client.generic('PATCH', self.url.format(import_id), json.dumps(changes),
+                                   content_type='application/json')
+
+    def get(self, url):
+        return json.loads(b''.join(self.client.get(url).streaming_content).decode('utf8')
+                          if url.endswith('citizens') else self.client.get(url).content)['data']
+
+    def test_bad_data(self):
+        import_id = create_import(self.client, generate_citizens(3, provide_relatives=False))
+        for changes in ([], {"citizen_id": 1, "changes": {"name": "Имя"}},
+                        [{"citizen_id": 1}],
+                        [{"citizen_id": 1, "changes": {}}],
+                        [{"citizen_id": -1, "changes": {"name": "Имя"}}],
+                        [{"citizen_id": 1, "changes": {"name": "Имя"}, "redundant": 1}],
+                        [{"citizen_id": 1, "changes": {"citizen_id": 2}}],
+                        [{"citizen_id": 1, "changes": {"name": "Имя"}}, {"citizen_id": 1, "changes": {"name": "Имя"}}],
+                        [{"citizen_id": 1, "changes": {"relatives": [2]}}, {"citizen_id": 2, "changes": {"relatives": []}}]):
+            response = self.patch(import_id, changes)
+            self.assertEqual(response.status_code, 400, changes)
+
+        self.assertEqual(self.patch(import_id + 1, [{"citizen_id": 1, "changes": {"name": "Имя"}}]).status_code, 404)
+        self.assertEqual(self.patch(import_id, [{"citizen_id": 4, "changes": {"name": "Имя"}}]).status_code, 404)
+        self.assertEqual(self.patch(import_id, [{"citizen_id": 1, "changes": {"relatives": [4]}}]).status_code, 404)
+        self.assertEqual(self.client.delete(self.url.format(import_id)).status_code, 405)
+
+    @override_settings(IMPORTS_REGISTRY_SIZE=0)
+    def test_out_of_range_ids(self):
+        import_id = create_import(self.client, generate_citizens(3, provide_relatives=False))
+        for changes in ([{"citizen_id": 2 ** 40, "changes": {"name": "Имя"}}],
+                        [{"citizen_id": 1, "changes": {"name": "Имя"}}, {"citizen_id": 2 ** 70, "changes": {"name": "Имя"}}],
+                        [{"citizen_id": 1, "changes": {"relatives": [2 ** 40]}}],
+                        [{"citizen_id": 1, "changes": {"relatives": [2, 2 ** 70]}}]):
+            self.assertEqual(self.patch(import_id, changes).status_code, 404, changes)
+
+    def test_same_as_single_patches(self):
+        citizens = generate_citizens(30)
+        for citizen in citizens:
+            citizen.town = random.choice(['Москва', 'Ташкент', 'Керчь'])
+        import_id = create_import(self.client, citizens)
+        expected_id = create_import(self.client, citizens)
+
+        rnd = random.Random(0)
+        for _ in range(10):
+            batch = {}
+            for citizen_id in rnd.sample(range(1, 31), rnd.randint(1, 6)):
+                changes = {}
+                if rnd.random() < 0.6:
+                    changes['relatives'] = rnd.sample(range(1, 31), rnd.randint(0, 4))
+                if rnd.random() < 0.4:
+                    changes['town'] = rnd.choice(['Москва', 'Ташкент', 'Керчь', 'Тверь'])
+                if rnd.random() < 0.4 or not changes:
+                    changes['birth_date'] = '{:02}.{:02}.19{}'.format(rnd.randint(1, 28), rnd.randint(1, 12),
+                                                                     rnd.randint(50, 99))
+                batch[citizen_id] = changes
+            # Родственники жителей из одного пакета должны быть согласованы
+            for citizen_id, changes in batch.items():
+                for rel_id in changes.get('relatives', ()):
+                    rel_relatives = batch.get(rel_id, {}).get('relatives')
+                    if rel_relatives is not None and citizen_id not in rel_relatives:
+                        rel_relatives.append(citizen_id)
+
+            response = self.patch(import_id, [{"citizen_id": citizen_id, "changes": changes}
+                                              for citizen_id, changes in batch.items()])
+            self.assertEqual(response.status_code, 200)
+            updated = json.loads(response.content.decode('utf8'))['data']
+            for citizen_id, changes in batch.items():
+                self.client.generic('PATCH', '{}/{}'.format(self.url.format(expected_id), citizen_id),
+                                    json.dumps(changes), content_type='application/json')
+
+            expected = {citizen['citizen_id']: citizen for citizen in self.get(self.url.format(expected_id))}
+            for citizen in expected.values():
+                citizen['relatives'].sort()
+            for citizen in updated:
+                citizen['relatives'].sort()
+                self.assertEqual(citizen, expected[citizen['citizen_id']])
+            actual = self.get(self.url.format(import_id))
+            for citizen in actual:
+                citizen['relatives'].sort()
+            self.assertCountEqual(actual, expected.values())
+            birthdays = self.get('/imports/{}/citizens/birthdays'.format(import_id))
+            with self.settings(IMPORTS_BIRTHDAYS_ENGINE='sql'):
+                self.assertEqual(birthdays, self.get('/imports/{}/citizens/birthdays'.format(expected_id)))
+            percentile = self.get('/imports/{}/towns/stat/percentile/age'.format(import_id))
+            with self.settings(IMPORTS_PERCENTILE_ENGINE='python'):
+                self.assertCountEqual(percentile, self.get('/imports/{}/towns/stat/percentile/age'.format(expected_id)))
+
+
+class TestImportRegistry(TransactionTestCase):
+    # Реестр запоминает только закоммиченное, поэтому тут нужны настоящие транзакции
+
+    def setUp(self):
+        import_registry.clear()
+        self.addCleanup(import_registry.clear)
+
+    @staticmethod
+    def counted(request):
+        with CaptureQueriesContext(connection) as queries:
+            response = request()
+            if response.streaming:
+                b''.join(response.streaming_content)
+        return response, count_queries(queries)
+
+    def test_known_import(self):
+        citizens = generate_citizens(10)
+        import_id = create_import(self.client, citizens)
+        self.assertTrue(import_registry.exists(import_id))
+        self.assertEqual(len(import_registry.get(import_id)[1]), 10)
+
+        url = '/imports/{}/citizens?limit=5'.format(import_id)
+        response, known_queries = self.counted(lambda: self.client.get(url))
+        self.assertEqual(response.status_code, 200)
+        with self.settings(IMPORTS_REGISTRY_SIZE=0):
+            expected, queries = self.counted(lambda: self.client.get(url))
+        self.assertEqual(response.content, expected.content)
+        self.assertEqual(known_queries, queries - 1)
+
+        patch_url = '/imports/{}/citizens/1'.format(import_id)
+        response, queries = self.counted(lambda: self.client.generic(
+            'PATCH', patch_url, json.dumps({'relatives': [11]}), content_type='application/json'))
+        self.assertEqual((response.status_code, queries), (404, 0))
+        response, queries = self.counted(lambda: self.client.generic(
+            'PATCH', '/imports/{}/citizens/11'.format(import_id), json.dumps({'name': 'Имя'}),
+            content_type='application/json'))
+        self.assertEqual((response.status_code, queries), (404, 0))
+        response = self.client.generic('PATCH', patch_url, json.dumps({'relatives': [2, 3]}),
+                                       content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_lazy_citizen_map(self):
+        citizens = generate_citizens(5, provide_relatives=False)
+        import_id = create_import(self.client, citizens)
+        import_registry.clear()
+
+        self.assertIsNone(import_registry.citizen_map(import_id + 1))
+        self.assertFalse(import_registry.exists(import_id + 1))
+        url = '/imports/{}/citizens'.format(import_id)
+        changes = [{"citizen_id": 1, "changes": {"relatives": [2]}}, {"citizen_id": 2, "changes": {"relatives": [1]}}]
+        response = self.client.generic('PATCH', url, json.dumps(changes), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(import_registry.get(import_id)[1]), 5)
+        changes = [{"citizen_id": 1, "changes": {"relatives": [6]}}]
+        response, queries = self.counted(lambda: self.client.generic(
+            'PATCH', url, json.dumps(changes), content_type='application/json'))
+        self.assertEqual((response.status_code, queries), (404, 0))
+
+    def test_eviction(self):
+        citizen_map = CitizenMap([3, 1, 2], [30, 10, 20])
+        self.assertEqual(citizen_map.resolve([2, 3, 1]), [20, 30, 10])
+        self.assertEqual(citizen_map.resolve([]), [])
+        self.assertIsNone(citizen_map.resolve([4]))
+        self.assertIsNone(citizen_map.resolve([2 ** 70]))
+        self.assertIsNone(CitizenMap([], []).resolve([1]))
+
+        registry = ImportRegistry('IMPORTS_REGISTRY_SIZE')
+        with self.settings(IMPORTS_REGISTRY_SIZE=5):
+            registry.add(1, citizen_map)
+            registry.add(2)
+            registry.add(3)
+            self.assertTrue(registry.exists(1))
+            registry.add(4)
+            self.assertEqual([registry.exists(import_id) for import_id in range(1, 5)], [True, False, True, True])
+            registry.add(5, CitizenMap(range(5), range(5)))
+            self.assertEqual([registry.exists(import_id) for import_id in range(1, 6)], [False] * 4 + [True])
+            self.assertEqual(registry.size, 5)
+        with self.settings(IMPORTS_REGISTRY_SIZE=0):
+            self.assertFalse(registry.exists(5))
+
+
 class TestGetCitizens(TestCase):
     url = '/imports/{:n}/citizens'
 
+    @staticmethod
+    def read(response):
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
     def test_incorrect_path_params(self):
         response = self.client.get(self.url.format(1000000))
         self.assertEqual(response.status_code, 404)
@@ -514,7 +1075,7 @@ class TestGetCitizens(TestCase):
         Citizen.save(db_citizen)
         response = self.client.get(self.url.format(import_obj.import_id))
         self.assertEqual(response.status_code, 200)
-        response_citizens = json.loads(response.content.decode('utf8'))['data']
+        response_citizens = json.loads(self.read(response).decode('utf8'))['data']
         self.assertEqual(type(response_citizens), list)
         self.assertEqual(len(response_citizens), 1)
         citizen = response_citizens[0]
@@ -545,7 +1106,7 @@ class TestGetCitizens(TestCase):
         db_citizens[0].relatives.set(db_citizens[1:])
         response = self.client.get(self.url.format(import_obj.import_id))
         self.assertEqual(response.status_code, 200)
-        response_citizens = json.loads(response.content.decode('utf8'))['data']
+        response_citizens = json.loads(self.read(response).decode('utf8'))['data']
         self.assertEqual(type(response_citizens), list)
         self.assertEqual(len(response_citizens), 3)
         for json_citizen in response_citizens:
@@ -571,7 +1132,7 @@ class TestGetCitizens(TestCase):
         response = self.client.get(self.url.format(import_obj.import_id))
         e = datetime.datetime.now()
         self.assertEqual(response.status_code, 200)
-        response_citizens = json.loads(response.content.decode('utf8'))['data']
+        response_citizens = json.loads(self.read(response).decode('utf8'))['data']
         self.assertEqual(type(response_citizens), list)
         self.assertEqual(len(response_citizens), 10000)
         for response_cit in response_citizens:
@@ -588,6 +1149,221 @@ class TestGetCitizens(TestCase):
         self.assertLess((e-s).total_seconds(), 5)
         print("Get - {}".format((e-s).total_seconds()))
 
+    def test_pagination(self):
+        import_obj = Import()
+        Import.save(import_obj)
+        gen_citizens = generate_citizens_in_db(import_obj, 25)
+        url = self.url.format(import_obj.import_id)
+
+        citizen_ids = []
+        pages = 0
+        query = '?limit=10'
+        while query is not None:
+            response = self.client.get(url + query)
+            self.assertEqual(response.status_code, 200)
+            page = json.loads(self.read(response).decode('utf8'))
+            self.assertLessEqual(len(page['data']), 10)
+            citizen_ids += [citizen['citizen_id'] for citizen in page['data']]
+            pages += 1
+            if page['next_cursor'] is None:
+                query = None
+            else:
+                self.assertEqual(page['next_cursor'], page['data'][-1]['citizen_id'])
+                query = '?limit=10&after_citizen_id={}'.format(page['next_cursor'])
+        self.assertEqual(pages, 3)
+        self.assertEqual(citizen_ids, sorted(citizen.citizen_id for citizen in gen_citizens))
+
+        response = self.client.get(url + '?after_citizen_id={}'.format(max(citizen_ids)))
+        self.assertEqual(json.loads(self.read(response).decode('utf8')), {'data': [], 'next_cursor': None})
+
+        for query in ('?limit=0', '?limit=abc', '?after_citizen_id=1.5', '?limit=100000'):
+            self.assertEqual(self.client.get(url + query).status_code, 400)
+        self.assertEqual(self.client.get(self.url.format(1000000) + '?limit=10').status_code, 404)
+
+    def test_fields(self):
+        import_obj = Import()
+        Import.save(import_obj)
+        generate_citizens_in_db(import_obj, 20)
+        url = self.url.format(import_obj.import_id)
+        full = {citizen['citizen_id']: citizen for citizen in json.loads(self.read(self.client.get(url)).decode('utf8'))['data']}
+        for citizen in full.values():
+            citizen['relatives'].sort()
+
+        for fields in (('citizen_id', 'relatives'), ('town', 'birth_date'), ('name',)):
+            response = self.client.get(url + '?fields=' + ','.join(reversed(fields)))
+            self.assertEqual(response.status_code, 200)
+            citizens = json.loads(self.read(response).decode('utf8'))['data']
+            self.assertEqual(len(citizens), len(full))
+            for citizen in citizens:
+                self.assertEqual(tuple(citizen.keys()), fields)
+                citizen.get('relatives', []).sort()
+            self.assertCountEqual([json.dumps(citizen, sort_keys=True) for citizen in citizens],
+                                  [json.dumps({field: citizen[field] for field in fields}, sort_keys=True)
+                                   for citizen in full.values()])
+
+        response = self.client.get(url + '?fields=citizen_id,gender&limit=5&after_citizen_id=3')
+        page = json.loads(self.read(response).decode('utf8'))
+        self.assertEqual(page['data'], [{'citizen_id': citizen_id, 'gender': full[citizen_id]['gender']}
+                                        for citizen_id in sorted(full)[3:8]])
+        self.assertEqual(page['next_cursor'], 8)
+
+        for query in ('?fields=', '?fields=town,password', '?fields=id'):
+            self.assertEqual(self.client.get(url + query).status_code, 400)
+
+
+@override_settings(IMPORTS_CITIZENS_ENGINE='python')
+class TestGetCitizensInMemory(TestGetCitizens):
+    pass
+
+
+@override_settings(IMPORTS_CITIZENS_ENGINE='postgres')
+class TestGetCitizensInPostgres(TestGetCitizens):
+
+    def test_identical_output(self):
+        import_obj = Import()
+        Import.save(import_obj)
+        gen_citizens = generate_citizens(2, provide_relatives=False)
+        gen_citizens[0].name = 'Кавычки " и \\ слеш / \n\t\x01 \u2028 😀'
+        gen_citizens[1].town = '\x7f\x1f'
+        gen_citizens[1].birth_date = '01.01.0999'
+        db_citizens = [Citizen(import_id=import_obj,
+                               citizen_id=citizen.citizen_id,
+                               town=citizen.town,
+                               street=citizen.street,
+                               appartement=citizen.appartement,
+                               name=citizen.name,
+                               birth_date=datetime.datetime.strptime(citizen.birth_date, "%d.%m.%Y"),
+                               gender=citizen.gender,
+                               building=citizen.building) for citizen in gen_citizens]
+        Citizen.objects.bulk_create(db_citizens)
+        db_citizens[0].relatives.set(db_citizens[1:])
+        response = self.client.get(self.url.format(import_obj.import_id))
+        self.assertEqual(response.status_code, 200)
+        content = self.read(response)
+        with self.settings(IMPORTS_CITIZENS_ENGINE='python'):
+            expected = self.client.get(self.url.format(import_obj.import_id)).content
+        self.assertEqual(len(content), len(expected))
+        for citizen in json.loads(expected.decode('utf8'))['data']:
+            self.assertIn(json.dumps(citizen, ensure_ascii=False).encode('utf8'), content)
+
+
+class TestConditionalGet(TestCase):
+
+    def test_etag(self):
+        citizens = generate_citizens(10, provide_relatives=False)
+        import_id = create_import(self.client, citizens)
+        urls = ['/imports/{}/citizens'.format(import_id),
+                '/imports/{}/citizens/birthdays'.format(import_id),
+                '/imports/{}/towns/stat/percentile/age'.format(import_id)]
+
+        etags = {}
+        for url in urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etags[url] = response['ETag']
+            with self.assertNumQueries(1):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 304)
+        self.assertIn(datetime.datetime.utcnow().strftime('%Y%m%d'), etags[urls[2]])
+
+        response = self.client.generic('PATCH', '/imports/{}/citizens/{}'.format(import_id, citizens[0].citizen_id),
+                                       json.dumps({'name': 'Новое имя'}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        for url in urls:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etags[url])
+
+        response = self.client.get('/imports/1000000/citizens', HTTP_IF_NONE_MATCH=etags[urls[0]])
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.has_header('ETag'))
+
+
+class TestResponseCache(TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        overridden = self.settings(IMPORTS_RESPONSE_CACHE_DIR=cache_dir, IMPORTS_RESPONSE_CACHE_SIZE=256 * 1024 * 1024)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+    def create_import(self, count=10):
+        citizens = generate_citizens(count)
+        return create_import(self.client, citizens), citizens
+
+    def stats(self):
+        return json.loads(self.client.get('/imports/cache/stats').content)['data']
+
+    def test_hit_and_version(self):
+        import_id, citizens = self.create_import()
+        url = '/imports/{}/citizens'.format(import_id)
+        response = self.client.get(url)
+        content = b''.join(response.streaming_content)
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.content, content)
+        stats = self.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['size'], len(content))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+        response = self.client.get(url + '?fields=citizen_id')
+        self.assertNotEqual(b''.join(response.streaming_content), content)
+
+        response = self.client.generic('PATCH', '/imports/{}/citizens/{}'.format(import_id, citizens[0].citizen_id),
+                                       json.dumps({'name': 'Новое имя'}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url)
+        self.assertIn('Новое имя'.encode('utf8'), b''.join(response.streaming_content))
+        self.assertEqual(self.stats()['misses'], 3)
+
+    def test_eviction(self):
+        import_id, _ = self.create_import()
+        urls = ['/imports/{}/citizens/birthdays'.format(import_id),
+                '/imports/{}/towns/stat/percentile/age'.format(import_id)]
+        sizes = [len(self.client.get(url).content) for url in urls]
+        self.assertEqual(self.stats()['evictions'], 0)
+        cache.invalidate(import_id)
+        self.assertEqual(self.stats()['size'], 0)
+
+        with self.settings(IMPORTS_RESPONSE_CACHE_SIZE=max(sizes) + 1):
+            for url in urls:
+                self.client.get(url)
+            stats = self.stats()
+            self.assertEqual(stats['evictions'], 1)
+            self.assertEqual(stats['size'], sizes[1])
+            self.client.get(urls[1])
+            self.assertEqual(self.stats()['hits'], 1)
+
+    def test_disabled(self):
+        import_id, _ = self.create_import()
+        with self.settings(IMPORTS_RESPONSE_CACHE_SIZE=0):
+            self.client.get('/imports/{}/citizens/birthdays'.format(import_id))
+        self.assertEqual(self.stats()['misses'], 0)
+
+
+class TestCitizensSerializer(TestCase):
+
+    def test_identical_output(self):
+        citizens = generate_citizens(200)
+        citizens[0].name = 'Кавычки " и \\ слеш / \n\t\x01 \u2028 😀'
+        citizens[1].town = '\x7f\u0000'
+        citizens[2].relatives = []
+        self.assertEqual(dump_citizens_response(citizens),
+                         json.dumps(DataResponse(citizens).__dict__, cls=CitizenDTOEncoder, ensure_ascii=False).encode('utf8'))
+        self.assertEqual(dump_citizen_response(citizens[0]),
+                         json.dumps(DataResponse(citizens[0]).__dict__, cls=CitizenDTOEncoder, ensure_ascii=False).encode('utf8'))
+        self.assertEqual(dump_citizens_response([]), json.dumps(DataResponse([]).__dict__).encode('utf8'))
+
+    def test_stream_output(self):
+        citizens = generate_citizens(5)
+        rows = [(citizen.citizen_id, citizen.town, citizen.street, citizen.building, citizen.appartement, citizen.name,
+                 datetime.datetime.strptime(citizen.birth_date, "%d.%m.%Y").date(), citizen.gender, citizen.relatives)
+                for citizen in citizens]
+        self.assertEqual(b''.join(iter_citizens_response([rows[:2], rows[2:]])), dump_citizens_response(citizens))
+        self.assertEqual(b''.join(iter_citizens_response([])), dump_citizens_response([]))
+
 
 class TestBirthDate(TestCase):
 
@@ -668,6 +1444,43 @@ class TestBirthDate(TestCase):
         print("Birth_Date - {}".format((e-s).total_seconds()))
         self.assertLess((e-s).total_seconds(), 5)
 
+    def expected_birthdays(self, import_id):
+        answer = {str(month): [] for month in range(1, 13)}
+        for citizen in Citizen.objects.filter(import_id=import_id).order_by('citizen_id'):
+            months = [0] * 12
+            for relative in citizen.relatives.all():
+                months[relative.birth_date.month - 1] += 1
+            for month, presents in enumerate(months):
+                if presents:
+                    answer[str(month + 1)].append({"citizen_id": citizen.citizen_id, "presents": presents})
+        return answer
+
+    def test_incremental_updates(self):
+        citizens = generate_citizens(30)
+        import_id = create_import(self.client, citizens)
+        self.assertEqual(json.loads(self.client.get(self.url.format(import_id)).content)['data'],
+                         self.expected_birthdays(import_id))
+
+        rnd = random.Random(0)
+        url = '/imports/{}/citizens/{{}}'.format(import_id)
+        for _ in range(30):
+            citizen_id = rnd.randint(1, 30)
+            patch = {}
+            if rnd.random() < 0.7:
+                patch['relatives'] = rnd.sample(range(1, 31), rnd.randint(0, 5))
+            if rnd.random() < 0.5 or not patch:
+                patch['birth_date'] = '{:02}.{:02}.19{}'.format(rnd.randint(1, 28), rnd.randint(1, 12), rnd.randint(50, 99))
+            response = self.client.generic('PATCH', url.format(citizen_id), json.dumps(patch),
+                                           content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(self.client.get(self.url.format(import_id)).content)['data'],
+                             self.expected_birthdays(import_id))
+
+
+@override_settings(IMPORTS_BIRTHDAYS_ENGINE='sql')
+class TestBirthDateSql(TestBirthDate):
+    pass
+
 
 class TestPercentile(TestCase):
 
@@ -761,6 +1574,57 @@ class TestPercentile(TestCase):
             self.assertEqual(town_info['p75'], round(numpy.percentile(ages[town_info['town']], 75), 2))
             self.assertEqual(town_info['p99'], round(numpy.percentile(ages[town_info['town']], 99), 2))
 
+    def test_incremental_updates(self):
+        citizens = generate_citizens(40, provide_relatives=False)
+        for citizen in citizens:
+            citizen.town = random.choice(['Москва', 'Ташкент', 'Керчь'])
+        import_id = create_import(self.client, citizens)
+
+        rnd = random.Random(0)
+        for _ in range(20):
+            patch = {}
+            if rnd.random() < 0.5:
+                patch['town'] = rnd.choice(['Москва', 'Ташкент', 'Керчь', 'Тверь'])
+            if rnd.random() < 0.5 or not patch:
+                patch['birth_date'] = '{:02}.{:02}.19{}'.format(rnd.randint(1, 28), rnd.randint(1, 12), rnd.randint(50, 99))
+            response = self.client.generic('PATCH', '/imports/{}/citizens/{}'.format(import_id, rnd.randint(1, 40)),
+                                           json.dumps(patch), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            response_data = json.loads(self.client.get(self.url.format(import_id)).content)['data']
+            with self.settings(IMPORTS_PERCENTILE_ENGINE='python'):
+                expected = json.loads(self.client.get(self.url.format(import_id)).content)['data']
+            self.assertCountEqual(response_data, expected)
+            with self.settings(IMPORTS_PERCENTILE_ENGINE='numpy'):
+                response_data = json.loads(self.client.get(self.url.format(import_id)).content)['data']
+            self.assertCountEqual(response_data, expected)
+
+    def test_day_cache(self):
+        citizens = generate_citizens(20, provide_relatives=False)
+        import_id = create_import(self.client, citizens)
+        result = handle_percentile(import_id)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertIs(handle_percentile(import_id), result)
+        self.assertEqual(count_queries(queries), 1)
+        self.client.generic('PATCH', '/imports/{}/citizens/{}'.format(import_id, citizens[0].citizen_id),
+                            json.dumps({'town': 'Новый город'}), content_type='application/json')
+        self.assertIn('Новый город', [town['town'] for town in handle_percentile(import_id)])
+
+        day_cache = cache.DayCache('IMPORTS_PERCENTILE_CACHE_SIZE')
+        today = datetime.date(2020, 1, 1)
+        self.assertEqual(day_cache.get_or_compute('key', today, lambda: 1), 1)
+        self.assertEqual(day_cache.get_or_compute('key', today, lambda: 2), 1)
+        self.assertEqual(day_cache.get_or_compute('key', today + datetime.timedelta(days=1), lambda: 3), 3)
+        with self.settings(IMPORTS_PERCENTILE_CACHE_SIZE=1):
+            day_cache.get_or_compute('other', today + datetime.timedelta(days=1), lambda: 4)
+            self.assertEqual(day_cache.get_or_compute('key', today + datetime.timedelta(days=1), lambda: 5), 5)
+
+    def test_calculate_ages(self):
+        today = datetime.date(2020, 3, 1)
+        birth_dates = [datetime.date(2000, 2, 29), datetime.date(2000, 3, 1), datetime.date(2000, 3, 2),
+                       datetime.date(1969, 12, 31), datetime.date(1900, 1, 1), datetime.date(2019, 12, 31)]
+        self.assertEqual(calculate_ages(numpy.array(birth_dates, dtype='datetime64[D]'), today).tolist(),
+                         [calculate_age(birth_date, today) for birth_date in birth_dates])
+
     def test_max_citizen_batch(self):
         import_obj = Import()
         Import.save(import_obj)
@@ -4,6 +4,9 @@ from . import views
 
 urlpatterns = [
     path('', views.imports, name='imports'),
+    path('/ndjson', views.imports_ndjson, name='imports_ndjson'),
+    path('/jobs/<int:job_id>', views.imports_job, name='imports_job'),
+    path('/cache/stats', views.imports_cache_stats, name='imports_cache_stats'),
     path('/<int:import_id>/citizens/<int:citizen_id>', views.imports_change, name='imports_change'),
     path('/<int:import_id>/citizens', views.imports_all, name='imports_all'),
     path('/<int:import_id>/citizens/birthdays', views.imports_birthdays, name='imports_birthdays'),
@@ -0,0 +1,362 @@
+import datetime
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain, islice
+
+import numpy
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+from imports.exceptions import NotSymmetricalRelatives, BadRelativesGiven
+from imports.dto import CitizenRecord
+
+MISSING = object()
+date_format = '%d.%m.%Y'
+genders = ('male', 'female')
+
+STRING = 'string'
+INTERNED_STRING = 'interned string'
+INTEGER = 'integer'
+DATE = 'date'
+GENDER = 'gender'
+
+CITIZEN_SCHEMA = (
+    ('town', INTERNED_STRING),
+    ('street', INTERNED_STRING),
+    ('building', STRING),
+    ('appartement', INTEGER),
+    ('name', STRING),
+    ('birth_date', DATE),
+    ('gender', GENDER),
+)
+
+
+# Даты рождения в выгрузках сильно повторяются, поэтому strptime кешируем между запросами
+@lru_cache(maxsize=65536)
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, date_format).date()
+    except ValueError:
+        return None
+
+
+class CitizenValidator:
+    """
+    Валидатор жителя, собранный один раз по схеме полей: сообщения об ошибках
+    форматируются заранее, а "сегодня" вычисляется один раз на весь запрос.
+    Повторяющиеся названия городов и улиц хранятся в одном экземпляре на весь запрос
+    """
+
+    def __init__(self, schema=CITIZEN_SCHEMA, today=None):
+        self.today = today if today is not None else datetime.datetime.utcnow().date()
+        self.strings = {}
+        self.checks = [(field_name, self.compile(field_name, kind), "{} not specified".format(field_name))
+                       for field_name, kind in schema]
+
+    def compile(self, field_name, kind):
+        if kind == INTEGER:
+            return self.compile_integer(field_name)
+        check_string = self.compile_string(field_name)
+        if kind == STRING:
+            return check_string
+        if kind == INTERNED_STRING:
+            return self.compile_interned(check_string)
+        if kind == DATE:
+            return self.compile_date(field_name, check_string)
+        if kind == GENDER:
+            return self.compile_gender(check_string)
+        raise ValueError("Unknown field kind - {}".format(kind))
+
+    @staticmethod
+    def compile_integer(field_name):
+        not_integer = "{} must be integer".format(field_name)
+        negative = "{} must be not negative integer".format(field_name)
+
+        def check(value):
+            if type(value) is not int:
+                raise ValidationError(not_integer)
+            if value < 0:
+                raise ValidationError(negative)
+            return value
+        return check
+
+    @staticmethod
+    def compile_string(field_name):
+        not_string = "{} must be string".format(field_name)
+        bad_length = "{} must be string with length in (0, 256]".format(field_name)
+
+        def check(value):
+            if type(value) is not str:
+                raise ValidationError(not_string)
+            if len(value) > 256 or not value.strip():
+                raise ValidationError(bad_length)
+            return value
+        return check
+
+    def compile_interned(self, check_string):
+        strings = self.strings
+
+        def check(value):
+            return strings.setdefault(check_string(value), value)
+        return check
+
+    def compile_date(self, field_name, check_string):
+        bad_format = "{} invalid format. Must be '{}'".format(field_name, date_format)
+        future_date = "Future '{}' date given".format(field_name)
+        today = self.today
+
+        def check(value):
+            result = parse_date(check_string(value))
+            if result is None:
+                raise ValidationError(message=bad_format)
+            if result >= today:
+                raise ValidationError(future_date)
+            return result
+        return check
+
+    @staticmethod
+    def compile_gender(check_string):
+        def check(value):
+            if check_string(value) not in genders:
+                raise ValidationError("Invalid gender - {}. Must be only 'male' or 'female'".format(value))
+            return value
+        return check
+
+    def validate_citizen(self, citizen, full=True):
+        if type(citizen) is not dict:
+            raise ValidationError("citizen must be json object")
+        is_there_data = 0
+
+        if 'citizen_id' in citizen:
+            if not full:
+                raise ValidationError("citizen_id must not be specified")
+            citizen_id = citizen['citizen_id']
+            if citizen_id is None:
+                raise ValidationError("citizen_id not specified")
+            if type(citizen_id) is not int or citizen_id < 0:
+                raise ValidationError("citizen_id must be not negative integer")
+            is_there_data += 1
+        elif full:
+            raise ValidationError("citizen_id not specified")
+        else:
+            citizen_id = None
+
+        values = {}
+        for field_name, check, not_specified in self.checks:
+            value = citizen.get(field_name, MISSING)
+            if value is MISSING:
+                if full:
+                    raise ValidationError(not_specified)
+                values[field_name] = None
+                continue
+            if value is None:
+                raise ValidationError(not_specified)
+            values[field_name] = check(value)
+            is_there_data += 1
+
+        relatives = citizen.get('relatives', MISSING)
+        if relatives is MISSING:
+            if full:
+                raise ValidationError("relatives not specified")
+            relatives = None
+        else:
+            if relatives is None:
+                raise ValidationError("relatives not specified")
+            if type(relatives) is not list:
+                raise ValidationError(message="relatives must be list")
+            for rel_id in relatives:
+                if type(rel_id) is not int:
+                    raise ValidationError(message="relatives must be integers")
+            if len(set(relatives)) != len(relatives):
+                raise ValidationError("duplicate relatives ids given")
+            is_there_data += 1
+
+        if not is_there_data and not full:
+            raise ValidationError(message="No one field is provided. Must be at least one")
+
+        if len(citizen) > is_there_data:
+            raise ValidationError("there are {} redundant fields".format(len(citizen) - is_there_data))
+
+        return CitizenRecord(citizen_id=citizen_id, **values), relatives
+
+    def validate(self, data):
+        relative_map = {}
+        citizens = []
+        validate_citizen = self.validate_citizen
+        data = iter(data)
+        # Небольшие импорты валидируем в текущем процессе, а все, что сверх порога, - в пуле процессов
+        threshold = settings.IMPORTS_PARALLEL_VALIDATION_THRESHOLD
+        for citizen in data if threshold is None else islice(data, threshold):
+            citizen, relatives = validate_citizen(citizen)
+            citizens.append(citizen)
+            if citizen.citizen_id in relative_map:
+                raise ValidationError("not unique citizen_id into one date batch")
+            relative_map[citizen.citizen_id] = relatives
+        if threshold is not None and len(citizens) == threshold:
+            self.validate_parallel(data, citizens, relative_map)
+        check_relatives(relative_map)
+
+        return citizens, relative_map
+
+    def validate_changes(self, data):
+        """
+        Проверяет тело пакетного PATCH - список {citizen_id, changes}. Родственники жителей,
+        которые меняются в одном пакете, должны быть согласованы друг с другом
+        """
+        if type(data) is not list or not data:
+            raise ValidationError("changes must be not empty list")
+        changes = []
+        citizen_ids = set()
+        relative_map = {}
+        for item in data:
+            if type(item) is not dict or set(item) != {'citizen_id', 'changes'}:
+                raise ValidationError("each change must be json object with citizen_id and changes only")
+            citizen_id = item['citizen_id']
+            if type(citizen_id) is not int or citizen_id < 0:
+                raise ValidationError("citizen_id must be not negative integer")
+            if citizen_id in citizen_ids:
+                raise ValidationError("not unique citizen_id into one changes batch")
+            citizen_ids.add(citizen_id)
+            citizen, relatives = self.validate_citizen(item['changes'], full=False)
+            citizen.citizen_id = citizen_id
+            changes.append((citizen_id, citizen, relatives))
+            if relatives is not None:
+                relative_map[citizen_id] = set(relatives)
+        for citizen_id, relatives in relative_map.items():
+            for rel_id in relatives:
+                if rel_id in relative_map and citizen_id not in relative_map[rel_id]:
+                    raise NotSymmetricalRelatives(citizen_id, rel_id)
+        return changes
+
+    def validate_parallel(self, data, citizens, relative_map):
+        pool, pool_size = get_process_pool()
+        shard_size = settings.IMPORTS_VALIDATION_SHARD_SIZE
+        pending = deque()
+        try:
+            for shard in iter(lambda: list(islice(data, shard_size)), []):
+                pending.append(pool.submit(validate_shard, shard, self.today))
+                # Шарды сливаем строго по порядку, чтобы ошибка была той же, что и при последовательной проверке
+                while pending and (pending[0].done() or len(pending) > pool_size * 2):
+                    self.merge_shard(pending.popleft().result(), citizens, relative_map)
+            while pending:
+                self.merge_shard(pending.popleft().result(), citizens, relative_map)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def merge_shard(self, shard_result, citizens, relative_map):
+        columns, error = shard_result
+        citizen_ids, towns, streets, buildings, appartements, names, birth_dates, genders, relatives = columns
+        size = len(relative_map)
+        relative_map.update(zip(citizen_ids, relatives))
+        if len(relative_map) != size + len(citizen_ids):
+            raise ValidationError("not unique citizen_id into one date batch")
+        strings = self.strings
+        citizens.extend(map(CitizenRecord, citizen_ids, map(strings.setdefault, towns, towns),
+                            map(strings.setdefault, streets, streets), buildings, appartements, names, birth_dates,
+                            genders))
+        if error is not None:
+            raise ValidationError(error)
+
+
+SHARD_COLUMNS = ('citizen_id', 'town', 'street', 'building', 'appartement', 'name', 'birth_date', 'gender')
+
+
+def validate_shard(shard, today):
+    # Выполняется в дочернем процессе. Ошибку возвращаем вместе с провалидированной частью шарда,
+    # чтобы родитель успел проверить уникальность citizen_id до места ошибки.
+    # Результат - столбцы кортежей, а не объекты: их родитель распаковывает вдвое быстрее,
+    # а одинаковые города, улицы и даты pickle передает по одному разу
+    validator = CitizenValidator(today=today)
+    citizens = []
+    relatives = []
+    error = None
+    try:
+        for citizen in shard:
+            citizen, citizen_relatives = validator.validate_citizen(citizen)
+            citizens.append(citizen)
+            relatives.append(citizen_relatives)
+    except ValidationError as e:
+        error = e.message
+    columns = tuple(tuple(getattr(citizen, field) for citizen in citizens) for field in SHARD_COLUMNS)
+    return columns + (relatives,), error
+
+
+process_pool = None
+
+
+def get_process_pool():
+    # Пул создаем лениво, уже внутри воркера gunicorn
+    global process_pool
+    if process_pool is None:
+        size = settings.IMPORTS_VALIDATION_PROCESSES or os.cpu_count()
+        process_pool = ProcessPoolExecutor(max_workers=size), size
+    return process_pool
+
+
+def check_relatives(relative_map):
+    """
+    Проверяет существование и симметричность родственных связей за O(E log E):
+    ребра переводятся в индексы жителей и кодируются одним int64, после чего для
+    каждого ребра (a, b) бинарным поиском ищется обратное (b, a)
+    """
+    try:
+        citizen_ids = numpy.fromiter(relative_map.keys(), dtype=numpy.int64, count=len(relative_map))
+        counts = numpy.fromiter(map(len, relative_map.values()), dtype=numpy.int64, count=len(relative_map))
+        edges_count = int(counts.sum())
+        if edges_count == 0:
+            return
+        to_ids = numpy.fromiter(chain.from_iterable(relative_map.values()), dtype=numpy.int64, count=edges_count)
+    except OverflowError:
+        # id не влезают в int64 - проверяем по-простому
+        return check_relatives_sets(relative_map)
+
+    citizens_count = len(citizen_ids)
+    order = numpy.argsort(citizen_ids, kind='stable')
+    sorted_ids = citizen_ids[order]
+    positions = numpy.minimum(numpy.searchsorted(sorted_ids, to_ids), citizens_count - 1)
+    exists = sorted_ids[positions] == to_ids
+
+    from_indexes = numpy.repeat(numpy.arange(citizens_count, dtype=numpy.int64), counts)
+    to_indexes = order[positions]
+    # Несуществующий родственник указывает на соседа по сортировке - такие ребра в поиск обратных не берем,
+    # иначе мнимое ребро может "подтвердить" настоящее одностороннее
+    edges = numpy.sort((from_indexes * citizens_count + to_indexes)[exists])
+    reverse_edges = (to_indexes * citizens_count + from_indexes)[exists]
+    symmetrical = numpy.zeros(edges_count, dtype=bool)
+    if len(edges):
+        found = numpy.minimum(numpy.searchsorted(edges, reverse_edges), len(edges) - 1)
+        symmetrical[exists] = edges[found] == reverse_edges
+
+    bad = ~(exists & symmetrical)
+    if bad.any():
+        # Возвращаем ту же ошибку, что дал бы последовательный обход relative_map
+        first = int(numpy.argmax(bad))
+        citizen_id, rel_id = int(citizen_ids[from_indexes[first]]), int(to_ids[first])
+        if not exists[first]:
+            raise BadRelativesGiven(citizen_id, rel_id)
+        raise NotSymmetricalRelatives(citizen_id, rel_id)
+
+
+def check_relatives_sets(relative_map):
+    relative_sets = {citizen_id: set(relatives) for citizen_id, relatives in relative_map.items()}
+    for citizen_id, relatives in relative_map.items():
+        for rel_id in relatives:
+            if rel_id not in relative_sets:
+                raise BadRelativesGiven(citizen_id, rel_id)
+            if citizen_id not in relative_sets[rel_id]:
+                raise NotSymmetricalRelatives(citizen_id, rel_id)
+
+
+def validate(data):
+    return CitizenValidator().validate(data)
+
+
+def validate_citizen(citizen, full=True):
+    return CitizenValidator().validate_citizen(citizen, full=full)
+
+
+def validate_changes(data):
+    return CitizenValidator().validate_changes(data)
@@ -1,63 +1,164 @@
 import json
+from datetime import datetime
 from json import JSONDecodeError
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.http import HttpResponse, HttpResponseNotAllowed
+from django.db import IntegrityError
+from django.http import HttpResponse, HttpResponseNotAllowed, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-
-from imports.dto import DataResponse, CitizenDTOEncoder
-from imports.exceptions import NotSymmetricalRelatives, BadRelativesGiven
+from django.views.decorators.http import condition
+
+from imports.cache import cached_response, get_stats as get_cache_stats
+from imports.dto import DataResponse
+from imports.exceptions import UnsupportedContentEncoding
+from imports.jobs import submit_import
+from imports.parsers import CHUNK_SIZE, body_stream, iter_citizens, iter_ndjson_citizens
+from imports.serializers import dump_citizen_response, dump_citizens_response, dump_citizens_page, dump_citizen_row, \
+    iter_citizens_response, make_citizen_row_dumper, parse_fields, relay_citizen_json
 from imports.service import *
+from imports.validators import validate, validate_changes, validate_citizen
 import logging
-import datetime
 logger = logging.getLogger(__name__)
 
-date_format = '%d.%m.%Y'
-
 
 @csrf_exempt
 def imports(request):
     if request.method == 'POST':
-        try:
-            data = json.loads(request.body.decode('utf8'))
-        except JSONDecodeError as e:
-            logger.debug("Can't parse request body json. {}".format(e.msg))
-            return HttpResponse(status=400)
-        except Exception:
-            logger.debug("Can't parse request body json.")
-            return HttpResponse(status=400)
-        if type(data) is not dict:
-            logger.debug("Request body is not json object. {}".format(data))
-            return HttpResponse(status=400)
-        if 'citizens' not in data.keys():
-            logger.debug("No found citizens key in incoming json. {}".format(data))
-            return HttpResponse(status=400)
-        data = data['citizens']
-        if data is None or type(data) is not list or len(data) == 0:
-            logger.debug("No citizens provided or they are not in list. {}".format(data))
-            return HttpResponse(status=400)
-        try:
-            citizens, relative_map = validate(data=data)
-        except ValidationError as e:
-            logger.debug("Validation failed. Message - {}".format(e.message))
-            return HttpResponse(e.message, status=400)
+        return add_import(request, iter_citizens)
+    else:
+        logger.debug("Only allowed POST Http method. Given - {}".format(request.method))
+        return HttpResponseNotAllowed(permitted_methods='POST')
 
-        # May be handle some additional exceptions
 
-        import_id = handle_add_import(citizens, relative_map)
-        data = DataResponse(import_id)
-        logger.debug("Success request processing. Import_id - {}".format(import_id['import_id']))
-        return HttpResponse(json.dumps(data.__dict__), status=201)
+@csrf_exempt
+def imports_ndjson(request):
+    if request.method == 'POST':
+        return add_import(request, iter_ndjson_citizens)
     else:
         logger.debug("Only allowed POST Http method. Given - {}".format(request.method))
         return HttpResponseNotAllowed(permitted_methods='POST')
 
 
+def add_import(request, parse):
+    idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+    if idempotency_key is not None:
+        if not 0 < len(idempotency_key) <= 256:
+            logger.debug("Invalid Idempotency-Key header. {}".format(idempotency_key))
+            return HttpResponse("Idempotency-Key must be string with length in (0, 256]", status=400)
+        previous = handle_find_request(idempotency_key)
+        if previous is not None:
+            return repeated_import(request, *previous)
+
+    try:
+        body = body_stream(request)
+    except UnsupportedContentEncoding as e:
+        logger.debug(e.message)
+        return HttpResponse(e.message, status=415)
+    try:
+        citizens, relative_map = validate(data=parse(body))
+    except JSONDecodeError as e:
+        logger.debug("Can't parse request body json. {}".format(e.msg))
+        return HttpResponse(status=400)
+    except ValidationError as e:
+        logger.debug("Validation failed. Message - {}".format(e.message))
+        return HttpResponse(e.message, status=400)
+    except ValueError:
+        logger.debug("Can't parse request body json.")
+        return HttpResponse(status=400)
+
+    digest = None
+    if idempotency_key is not None or settings.IMPORTS_DEDUPLICATE_BY_DIGEST:
+        digest = body.hexdigest()
+    if idempotency_key is None and digest is not None:
+        import_id = handle_find_import(digest=digest)
+        if import_id is not None:
+            logger.debug("Import already done for the same body. Import_id - {}".format(import_id['import_id']))
+            return import_created(import_id)
+
+    if 'respond-async' in request.META.get('HTTP_PREFER', ''):
+        job = submit_import(citizens, relative_map, idempotency_key, digest)
+        data = DataResponse({'job_id': job.job_id, 'status': job.status})
+        logger.debug("Import job accepted. Job_id - {}".format(job.job_id))
+        response = HttpResponse(json.dumps(data.__dict__), status=202)
+        response['Location'] = '/imports/jobs/{}'.format(job.job_id)
+        return response
+
+    # May be handle some additional exceptions
+
+    try:
+        import_id = handle_add_import(citizens, relative_map, idempotency_key, digest)
+    except IntegrityError:
+        # Параллельный повтор с тем же Idempotency-Key успел закоммитить импорт первым
+        previous = handle_find_request(idempotency_key) if idempotency_key is not None else None
+        if previous is None:
+            raise
+        if previous[1] != digest:
+            return idempotency_key_reused()
+        import_id = {'import_id': previous[0]}
+    logger.debug("Success request processing. Import_id - {}".format(import_id['import_id']))
+    return import_created(import_id)
+
+
+def repeated_import(request, import_id, digest):
+    # Повтор отдает прежний import_id, только если тело то же самое. Его не разбираем, а только хешируем
+    try:
+        body = body_stream(request)
+        for _ in iter(lambda: body.read(CHUNK_SIZE), b''):
+            pass
+    except UnsupportedContentEncoding as e:
+        logger.debug(e.message)
+        return HttpResponse(e.message, status=415)
+    except ValueError as e:
+        logger.debug("Can't read request body. {}".format(e))
+        return HttpResponse(status=400)
+    if body.hexdigest() != digest:
+        return idempotency_key_reused()
+    logger.debug("Import already done for Idempotency-Key. Import_id - {}".format(import_id))
+    return import_created({'import_id': import_id})
+
+
+def idempotency_key_reused():
+    logger.debug("Idempotency-Key already used with another request body")
+    return HttpResponse("Idempotency-Key already used with another request body", status=422)
+
+
+def import_created(import_id):
+    data = DataResponse(import_id)
+    return HttpResponse(json.dumps(data.__dict__), status=201)
+
+
+@csrf_exempt
+def imports_job(request, job_id):
+    if request.method == 'GET':
+        try:
+            response = handle_get_job(job_id)
+        except ImportJobNotFound as e:
+            logger.debug(e.message)
+            return HttpResponse(e.message, status=404)
+        data = DataResponse(response)
+        return HttpResponse(json.dumps(data.__dict__), status=200)
+    else:
+        return HttpResponseNotAllowed(permitted_methods='GET')
+
+
+@csrf_exempt
+def imports_cache_stats(request):
+    if request.method == 'GET':
+        data = DataResponse(get_cache_stats())
+        return HttpResponse(json.dumps(data.__dict__), status=200)
+    else:
+        return HttpResponseNotAllowed(permitted_methods='GET')
+
+
 @csrf_exempt
 def imports_change(request, import_id, citizen_id):
     if request.method == 'PATCH':
         try:
-            data = json.loads(request.body)
+            data = json.load(body_stream(request))
+        except UnsupportedContentEncoding as e:
+            logger.debug(e.message)
+            return HttpResponse(e.message, status=415)
         except Exception:
             logger.debug("Can't parse request body json")
             return HttpResponse(status=400)
@@ -75,29 +176,119 @@ def imports_change(request, import_id, citizen_id):
         except (ImportNotFound, CitizenNotFound, RelativesNotFound) as e:
             logger.debug(e.message)
             return HttpResponse(e.message, status=404)
-        data = DataResponse(response)
-        return HttpResponse(json.dumps(data.__dict__, cls=CitizenDTOEncoder, ensure_ascii=False).encode('utf8'), status=200)
+        return HttpResponse(dump_citizen_response(response), status=200)
     else:
         logger.debug("Only allowed PATCH Http method. Given - {}".format(request.method))
         return HttpResponseNotAllowed(permitted_methods='PATCH')
 
 
+def import_etag(request, import_id):
+    # Данные импорта меняются только через PATCH, который поднимает версию,
+    # поэтому для If-None-Match достаточно одной строки из imports_import.
+    # Версию запоминаем на запросе: ее спрашивают и condition, и кеш ответов
+    if not hasattr(request, 'import_version'):
+        request.import_version = handle_get_version(import_id)
+    version = request.import_version
+    return None if version is None else '{}-{}'.format(import_id, version)
+
+
+def import_day_etag(request, import_id):
+    # Возраст жителей зависит еще и от текущей даты
+    etag = import_etag(request, import_id)
+    return None if etag is None else '{}-{}'.format(etag, datetime.utcnow().strftime('%Y%m%d'))
+
+
 @csrf_exempt
 def imports_all(request, import_id):
     if request.method == 'GET':
-        try:
-            response = handle_get_import(import_id)
-        except ImportNotFound as e:
-            logger.debug(e.message)
-            return HttpResponse("No such import found", status=404)
-        data = DataResponse(response)
-        return HttpResponse(json.dumps(data.__dict__, cls=CitizenDTOEncoder, ensure_ascii=False).encode('utf8'), status=200)
+        return imports_citizens(request, import_id)
+    elif request.method == 'PATCH':
+        return imports_change_many(request, import_id)
     else:
-        logger.debug("Only allowed GET Http method. Given - {}".format(request.method))
-        return HttpResponseNotAllowed(permitted_methods='GET')
+        logger.debug("Only allowed GET and PATCH Http methods. Given - {}".format(request.method))
+        return HttpResponseNotAllowed(permitted_methods=('GET', 'PATCH'))
+
+
+@condition(etag_func=import_etag)
+@cached_response(etag_func=import_etag)
+def imports_citizens(request, import_id):
+    try:
+        fields = parse_fields(request.GET.get('fields'))
+    except ValidationError as e:
+        logger.debug(e.message)
+        return HttpResponse(e.message, status=400)
+    sql, dump_row = citizens_query(fields)
+    if 'after_citizen_id' in request.GET or 'limit' in request.GET:
+        return imports_page(request, import_id, sql, dump_row)
+
+    engine = settings.IMPORTS_CITIZENS_ENGINE
+    try:
+        if engine == 'python' and fields is None:
+            return HttpResponse(dump_citizens_response(handle_get_import(import_id)), status=200)
+        content = iter_citizens_response(handle_stream_import(import_id, sql), dump_row)
+    except ImportNotFound as e:
+        logger.debug(e.message)
+        return HttpResponse("No such import found", status=404)
+    if engine == 'python':
+        return HttpResponse(b''.join(content), status=200)
+    return StreamingHttpResponse(content, status=200)
+
+
+def imports_change_many(request, import_id):
+    try:
+        data = json.load(body_stream(request))
+    except UnsupportedContentEncoding as e:
+        logger.debug(e.message)
+        return HttpResponse(e.message, status=415)
+    except Exception:
+        logger.debug("Can't parse request body json")
+        return HttpResponse(status=400)
+    try:
+        changes = validate_changes(data)
+    except ValidationError as e:
+        logger.debug("Validation failed. {}".format(e.message))
+        return HttpResponse(e.message, status=400)
+
+    try:
+        response = handle_change_citizens(import_id, changes)
+    except (ImportNotFound, CitizenNotFound, RelativesNotFound) as e:
+        logger.debug(e.message)
+        return HttpResponse(e.message, status=404)
+    return HttpResponse(dump_citizens_response(response), status=200)
+
+
+def citizens_query(fields):
+    # SQL выборки жителей и сериализатор ее строк под текущий движок и ?fields=
+    if settings.IMPORTS_CITIZENS_ENGINE == 'postgres':
+        return citizens_json_sql if fields is None else citizens_projection_json_sql(fields), relay_citizen_json
+    if fields is None:
+        return citizens_sql, dump_citizen_row
+    return citizens_projection_sql(fields), make_citizen_row_dumper(fields)
+
+
+def imports_page(request, import_id, sql, dump_row):
+    try:
+        after_citizen_id = request.GET.get('after_citizen_id')
+        after_citizen_id = None if after_citizen_id is None else int(after_citizen_id)
+        limit = int(request.GET.get('limit', settings.IMPORTS_CITIZENS_PAGE_SIZE))
+    except ValueError:
+        logger.debug("Invalid pagination params. {}".format(request.GET.urlencode()))
+        return HttpResponse("after_citizen_id and limit must be integers", status=400)
+    if not 0 < limit <= settings.IMPORTS_CITIZENS_MAX_PAGE_SIZE:
+        logger.debug("Invalid page limit. {}".format(limit))
+        return HttpResponse("limit must be in (0, {}]".format(settings.IMPORTS_CITIZENS_MAX_PAGE_SIZE), status=400)
+
+    try:
+        rows, next_cursor = handle_get_import_page(import_id, after_citizen_id, limit, sql)
+    except ImportNotFound as e:
+        logger.debug(e.message)
+        return HttpResponse("No such import found", status=404)
+    return HttpResponse(dump_citizens_page(rows, next_cursor, dump_row), status=200)
 
 
 @csrf_exempt
+@condition(etag_func=import_etag)
+@cached_response(etag_func=import_etag)
 def imports_birthdays(request, import_id):
     if request.method == 'GET':
         try:
@@ -112,6 +303,8 @@ def imports_birthdays(request, import_id):
 
 
 @csrf_exempt
+@condition(etag_func=import_day_etag)
+@cached_response(etag_func=import_day_etag)
 def imports_percentile(request, import_id):
     if request.method == 'GET':
         try:
@@ -123,141 +316,3 @@ def imports_percentile(request, import_id):
         return HttpResponse(json.dumps(data.__dict__, ensure_ascii=False).encode('utf8'), status=200)
     else:
         return HttpResponseNotAllowed(permitted_methods='GET')
-
-
-def validate(data):
-    relative_map = {}
-    citizens = []
-    for citizen in data:
-        citizen, relatives = validate_citizen(citizen=citizen)
-        citizens.append(citizen)
-        if citizen.citizen_id not in relative_map.keys():
-            relative_map.update({citizen.citizen_id: relatives})
-        else:
-            raise ValidationError("not unique citizen_id into one date batch")
-    for citizen_id, relatives in relative_map.items():
-        for rel_id in relatives:
-            if rel_id not in relative_map.keys():
-                raise BadRelativesGiven(citizen_id, rel_id)
-            if citizen_id not in relative_map[rel_id]:
-                raise NotSymmetricalRelatives(citizen_id, rel_id)
-
-    return citizens, relative_map
-
-
-def validate_citizen(citizen, full=True):
-    citizen_keys = citizen.keys()
-
-    is_there_data = 0
-
-    if 'citizen_id' in citizen_keys:
-        if full:
-            if citizen['citizen_id'] is None:
-                raise ValidationError("citizen_id not specified")
-            if type(citizen['citizen_id']) is int and citizen['citizen_id'] >= 0:
-                citizen_id = citizen['citizen_id']
-                is_there_data += 1
-            else:
-                raise ValidationError("citizen_id must be not negative integer")
-        else:
-            raise ValidationError("citizen_id must not be specified")
-    elif full:
-        raise ValidationError("citizen_id not specified")
-    else:
-        citizen_id = None
-
-    town = check_field(citizen, 'town', full=full)
-    if town:
-        is_there_data += 1
-
-    street = check_field(citizen, 'street', full=full)
-    if street:
-        is_there_data += 1
-
-    building = check_field(citizen, 'building', full=full)
-    if building:
-        is_there_data += 1
-
-    appartement = check_field(citizen, 'appartement', full=full, check_int=True)
-    if appartement is not None:
-        is_there_data += 1
-
-    name = check_field(citizen, 'name', full=full)
-    if name:
-        is_there_data += 1
-
-    birth_date = check_field(citizen, 'birth_date', full=full, is_date=True)
-    if birth_date:
-        is_there_data += 1
-
-    gender = check_field(citizen, 'gender', full=full)
-    if gender is not None:
-        if gender != 'male' and gender != 'female':
-            raise ValidationError("Invalid gender - {}. Must be only 'male' or 'female'".format(gender))
-        is_there_data += 1
-
-    if 'relatives' in citizen.keys():
-        if citizen['relatives'] is not None:
-            relatives = citizen['relatives']
-            if type(relatives) is not list:
-                raise ValidationError(message="relatives must be list")
-            for rel_id in relatives:
-                if type(rel_id) is not int:
-                    raise ValidationError(message="relatives must be integers")
-            if len(set(relatives)) != len(relatives):
-                raise ValidationError("duplicate relatives ids given")
-            is_there_data += 1
-        else:
-            raise ValidationError("{} not specified".format('relatives'))
-    elif full:
-        raise ValidationError("{} not specified".format('relatives'))
-    else:
-        relatives = None
-
-    if not is_there_data and not full:
-        raise ValidationError(message="No one field is provided. Must be at least one")
-
-    if len(citizen_keys) > is_there_data:
-        raise ValidationError("there are {} redundant fields".format(len(citizen_keys) - is_there_data))
-
-    return (Citizen(citizen_id=citizen_id,
-                    town=town,
-                    street=street,
-                    building=building,
-                    appartement=appartement,
-                    name=name,
-                    birth_date=birth_date,
-                    gender=gender), relatives)
-
-
-def check_field(citizen, field_name, full=True, check_int=False, is_date=False):
-    if field_name in citizen.keys():
-        if citizen[field_name] is not None:
-            if check_int:
-                if type(citizen[field_name]) is not int:
-                    raise ValidationError("{} must be integer".format(field_name))
-                else:
-                    if citizen[field_name] < 0:
-                        raise ValidationError("{} must be not negative integer".format(field_name))
-            if not check_int:
-                if type(citizen[field_name]) is not str:
-                    raise ValidationError("{} must be string".format(field_name))
-                else:
-                    if len(citizen[field_name].strip()) == 0 or len(citizen[field_name]) > 256:
-                        raise ValidationError("{} must be string with length in (0, 256]".format(field_name))
-            if is_date:
-                try:
-                    result = datetime.datetime.strptime(citizen[field_name], date_format).date()
-                    if result >= datetime.datetime.utcnow().date():
-                        raise ValidationError("Future '{}' date given".format(field_name))
-                except ValueError:
-                    raise ValidationError(message="{} invalid format. Must be '{}'".format(field_name, date_format))
-            else:
-                result = citizen[field_name]
-        else:
-            raise ValidationError("{} not specified".format(field_name))
-    elif full:
-        raise ValidationError("{} not specified".format(field_name))
-    else:
-        result = None
-    return result